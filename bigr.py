@@ -21,6 +21,16 @@ freqs = m.count_freq()
 Step 3.
 Apply the model to disambiguation. This requires the path to the corpus directory, the extension of the files and the frequencies, that we counted earlier:
 m.start_apply('C:\\corpus', '.xhtml', freqs)
+To disambiguate in memory also the words that only have an unambiguous neighbour on the right,
+or whose left neighbour is disambiguated later, pass propagate=True.
+
+The counted bigrams can be saved and loaded later instead of searching the corpus again:
+m.save_model('C:\\bigrams.npz')
+m = GoodBigramsTrainer('C:\\bigrams.npz')
+
+With trigrams=True the trainer also counts the trigrams of three good words,
+and start_apply(..., trigrams=True) decides by the two previous words when the trigrams know them,
+backing off to the bigrams otherwise.
 
 
 """
@@ -28,7 +38,9 @@ __author__ = 'elmira'
 
 import os
 import codecs
+import numpy as np
 from lxml import etree
+from corpus import iter_sentences, iter_corpus
 from collections import defaultdict
 
 
@@ -43,68 +55,217 @@ class GoodBigramsTrainer:
     Then it is possible to use this information to cope with the resting homonimy.
     """
 
-    goodBigrs = []
-
-    def __init__(self, path, extension=".xhtml", printing=False):
+    def __init__(self, path, extension=".xhtml", printing=False, trigrams=False):
         """
         Starts the search.
 
-        path: unicode string containing the path to the directory where the corpus files are stored
+        path: unicode string containing the path to the directory where the corpus files are stored,
+              or to a cache made by corpus.compile_corpus,
+              or to a model file written by save_model, then the bigrams are loaded and the corpus is not searched
         extension: unicode string containing the ending of the filename, e.g. '.xhtml' or 'cheese.txt',
                    this helps to identify files that need to be searched
         printing: True or False,
                   False by default,
                   if the value is True, all bigrams are printed to file *good_bigrams.txt*
+        trigrams: True or False,
+                  False by default,
+                  if the value is True, the trigrams of good words are counted too (see search_trigrams)
+        If path is None, the search is skipped, the bigrams are collected sentence by sentence (see collect_sentence).
+        The bigrams are not kept, only the number of each pair (gr of the word, gr of the next word) is counted.
         """
         self.changes = 0
+        self.gram = []
+        self.tri = []
+        self.memo = {}
+        self.triMemo = {}
+        self.triPrefixes = {}
+        self.trigrams = trigrams
+        self.triCounts = PackedCounts()
+        self.grIds = {}
+        self.grList = []
+        self.counts = {}  # (id of the gr of the word << 32) | id of the gr of the next word: number of bigrams
+        self.order = []  # keys of counts in the order of their first occurrence
+        self.total = 0
+        self.dump = None
+        if path is None:
+            return
+        if os.path.isfile(path):
+            self.load_model(path)
+            return
         print 'Collecting good bigrams...'
-        for root, dirs, files in os.walk(path):
-            for fName in files:
-                if fName.endswith(extension):
-                    self.search_file(os.path.join(root, fName))
-        print 'Good bigrams collected. Total: %s bigrams.\r\n' %(len(self.goodBigrs))
         if printing:
-            f = codecs.open(u"good_bigrams.txt", "a", "utf-8")
-            f.write('\r\n'.join(self.goodBigrs))
-            f.close()
+            self.dump = codecs.open(u"good_bigrams.txt", "a", "utf-8")
+        for fName, sents in iter_corpus(path, extension):
+            self.search_file(fName, sents)
+        if printing:
+            self.dump.close()
+            self.dump = None
+        print 'Good bigrams collected. Total: %s bigrams.\r\n' %(self.total)
 
-    def search_file(self, fName):
+    def search_file(self, fName, sents=None):
         """
         Performs the search of good bigrams in a given file fName.
-        Writes the result to the array goodBigrs.
+        Counts the result with add_bigrams.
+        sents: the sentences of the file if they are already read (see iter_corpus), otherwise the file is parsed.
         """
         try:
-            root = etree.parse(fName).getroot()
             gram = []
-            for se in root[1]:
-                for w in range(len(se) - 1):
-                    nextWord = [ana for ana in se[w + 1] if "lex" in ana.attrib]  # not counting empty tags
-                    curWord = [ana for ana in se[w] if "lex" in ana.attrib]
-                    nextPoS = set([x.attrib["gr"].split(u',')[0] for x in nextWord])
-                    curPoS = set([x.attrib["gr"].split(u',')[0] for x in curWord])
-                    if (curPoS == {"V", "ADV"} or curPoS == {"PREP", "PRON"} or curPoS == {"V", "PRON"}) and len(curWord) == 2:  # treating special cases right
-                        curResult = True
-                    else:
-                        curResult = False
-                    if (nextPoS == {"V", "ADV"} or nextPoS == {"PREP", "PRON"} or nextPoS == {"V", "PRON"}) and len(nextWord) == 2:
-                        nextResult = True
-                    else:
-                        nextResult = False
-                    if len(nextWord) == 1 or nextResult:
-                        if len(curWord) == 1 or curResult:
-                            gram.append((nextWord[-1].tail, nextWord[-1].attrib[u'gr'],
-                                         curWord[-1].tail, curWord[-1].attrib[u'gr']))
-            for i in gram:
-                bigramString = i[0] + ' ' + i[1] + ' ' + i[2] + ' ' + i[3]
-                self.goodBigrs.append(bigramString)
+            tri = []
+            if sents is None:
+                sents = iter_sentences(fName)
+            for sent in sents:
+                gram += self.search_sentence(sent)
+                if self.trigrams:
+                    tri += self.search_trigrams(sent)
+            self.add_bigrams(gram)
+            self.add_trigrams(tri)
+        except ValueError:
+            raise  # too many grs for the trigrams, see add_trigrams
+        except:
+            print "Class - GoodBigrams; function - search_file(filename); fail at %s" % fName
+
+    def search_sentence(self, sent):
+        """
+        Returns the good bigrams of one sentence sent, a list of (wordform, [attributes of ana, ...]).
+        Each bigram is a tuple (next word, its gr, current word, its gr).
+        """
+        gram = []
+        for w in range(len(sent) - 1):
+            nextWord = [ana for ana in sent[w + 1][1] if "lex" in ana]  # not counting empty tags
+            curWord = [ana for ana in sent[w][1] if "lex" in ana]
+            nextPoS = set([x["gr"].split(u',')[0] for x in nextWord])
+            curPoS = set([x["gr"].split(u',')[0] for x in curWord])
+            if (curPoS == {"V", "ADV"} or curPoS == {"PREP", "PRON"} or curPoS == {"V", "PRON"}) and len(curWord) == 2:  # treating special cases right
+                curResult = True
+            else:
+                curResult = False
+            if (nextPoS == {"V", "ADV"} or nextPoS == {"PREP", "PRON"} or nextPoS == {"V", "PRON"}) and len(nextWord) == 2:
+                nextResult = True
+            else:
+                nextResult = False
+            if len(nextWord) == 1 or nextResult:
+                if len(curWord) == 1 or curResult:
+                    gram.append((sent[w + 1][0], nextWord[-1][u'gr'],
+                                 sent[w][0], curWord[-1][u'gr']))
+        return gram
+
+    def good_gr(self, anas):
+        """
+        Returns the gr of a word with the attributes of its anas, if the word is good as in search_sentence, or None.
+        """
+        word = [ana for ana in anas if "lex" in ana]
+        PoS = set([x["gr"].split(u',')[0] for x in word])
+        if len(word) == 1 or ((PoS == {"V", "ADV"} or PoS == {"PREP", "PRON"} or PoS == {"V", "PRON"}) and len(word) == 2):
+            return word[-1][u'gr']
+        return None
+
+    def search_trigrams(self, sent):
+        """
+        Returns the trigrams of the good words of one sentence sent, each trigram is a tuple of their grs.
+        """
+        grs = [self.good_gr(anas) for word, anas in sent]
+        return [tuple(grs[w:w + 3]) for w in xrange(len(grs) - 2) if None not in grs[w:w + 3]]
+
+    def add_trigrams(self, tri):
+        """
+        Counts the trigrams of grs, a trigram is packed into one integer of three 21-bit gr ids,
+        so there can be no more than 2 ** 21 grs. Raises ValueError if there are more,
+        search_file and end_file let it through, so the training stops.
+        """
+        for gr1, gr2, gr3 in tri:
+            key = self.gr_id(gr1) << 42 | self.gr_id(gr2) << 21 | self.gr_id(gr3)
+            if len(self.grList) > 2 ** 21:
+                raise ValueError('too many grs to pack the trigrams: %s, the limit is 2 ** 21' % len(self.grList))
+            self.triCounts.add(key)
+
+    def add_bigrams(self, gram):
+        """
+        Counts the bigrams returned by search_sentence, and writes them to the open file dump if there is one.
+        """
+        for i in gram:
+            key = self.gr_id(i[3]) << 32 | self.gr_id(i[1])
+            if key in self.counts:
+                self.counts[key] += 1
+            else:
+                self.counts[key] = 1
+                self.order.append(key)
+            if self.dump is not None:
+                if self.total:
+                    self.dump.write('\r\n')
+                self.dump.write(i[0] + ' ' + i[1] + ' ' + i[2] + ' ' + i[3])
+            self.total += 1
+
+    def gr_id(self, gr):
+        """
+        Returns the id of gr, adds it if it is new.
+        The ids of the grs of trigrams must be below 2 ** 21 (see add_trigrams).
+        """
+        if gr not in self.grIds:
+            self.grIds[gr] = len(self.grList)
+            self.grList.append(gr)
+        return self.grIds[gr]
+
+    def start_file(self, fName):
+        """
+        Starts a new file when the bigrams are collected sentence by sentence.
+        The bigrams of the file are kept in gram until end_file, so a file that fails is dropped as in search_file.
+        """
+        self.gram = []
+        self.tri = []
+
+    def collect_sentence(self, sent):
+        if self.gram is not None:
+            try:
+                self.gram += self.search_sentence(sent)
+                if self.trigrams:
+                    self.tri += self.search_trigrams(sent)
+            except:
+                self.gram = None
 
+    def end_file(self, fName):
+        try:
+            self.add_bigrams(self.gram)
+            self.add_trigrams(self.tri)
+        except ValueError:
+            raise  # too many grs for the trigrams, see add_trigrams
         except:
             print "Class - GoodBigrams; function - search_file(filename); fail at %s" % fName
+        self.gram = []
+        self.tri = []
+
+    def save_model(self, path):
+        """
+        Writes the counted bigrams to the file path as NumPy arrays:
+        grs - the grs by their ids, keys - the keys of counts in the order of their first occurrence, counts,
+        tri_keys and tri_counts - the counted trigrams (see PackedCounts).
+        """
+        f = open(path, 'wb')
+        self.triCounts.flush()
+        np.savez(f, grs=np.array(self.grList, dtype=np.unicode_), keys=np.array(self.order, dtype=np.int64),
+                 counts=np.array([self.counts[key] for key in self.order], dtype=np.int64),
+                 total=np.array([self.total], dtype=np.int64),
+                 tri_keys=self.triCounts.keys, tri_counts=self.triCounts.counts)
+        f.close()
+
+    def load_model(self, path):
+        """
+        Reads the bigrams written by save_model, count_freq then gives the same frequencies.
+        """
+        model = np.load(path)
+        self.grList = model['grs'].tolist()
+        self.grIds = dict((self.grList[i], i) for i in xrange(len(self.grList)))
+        self.order = model['keys'].tolist()
+        self.counts = dict(zip(self.order, model['counts'].tolist()))
+        self.total = int(model['total'][0])
+        if 'tri_keys' in model.files:
+            self.triCounts.keys, self.triCounts.counts = model['tri_keys'], model['tri_counts']
+        model.close()
+        print 'Good bigrams loaded from %s. Total: %s bigrams.\r\n' % (path, self.total)
 
     def count_freq(self, printing=False):
         """
-        Opens array with bigrams and counts frequency for each bigram.
-        Returns a dictionary { bigram:frequency }.
+        Turns the counted bigrams into a dictionary { bigram:frequency }, where a bigram is 'ana1 ana2',
+        the bigrams are inserted in the order of their first occurrence.
 
         printing: True or False,
                   False by default,
@@ -113,12 +274,8 @@ class GoodBigramsTrainer:
         """
         print 'Counting frequencies...\r\n'
         d = defaultdict(int)
-        for line in self.goodBigrs:
-            line = line.split()
-            k = line[3] + ' ' + line[1]
-            # if k not in d:
-            #     print k
-            d[k] += 1
+        for key in self.order:
+            d[self.grList[key >> 32] + ' ' + self.grList[key & 0xFFFFFFFF]] = self.counts[key]
         if printing:
             f2 = codecs.open(u"good_bigrams_frequency_morpho.txt", "w", "utf-8")
             # writes "ana1 ana2" freq
@@ -143,6 +300,87 @@ class GoodBigramsTrainer:
             d[items[0]].append((items[1], int(items[2])))
         return d
 
+    def compile_rules(self, freqs):
+        """
+        Compiles the rules of get_rules into an index for get_corpora.
+
+        Returns dictionary:
+        dictionary = {anaOfWord1: {anaOfWord2: (place in the list of get_rules, freq), ...}, ...}
+        """
+        index = {}
+        rules = self.get_rules(freqs)
+        for prev in rules:
+            successors = index[prev] = {}
+            for rank in xrange(len(rules[prev])):
+                gr, freq = rules[prev][rank]
+                if gr in successors:
+                    successors[gr] = (successors[gr][0], freq)
+                else:
+                    successors[gr] = (rank, freq)
+        return index
+
+    def best_trigram_anas(self, prev2WordAna, prevWordAna, anas):
+        """
+        Returns the anas of the word whose trigram with the two previous anas is the most frequent,
+        or an empty list if none of the trigrams was counted.
+        The winning grs are remembered for each (prev2WordAna, prevWordAna, set of grs of the anas),
+        and the counted trigrams for each pair of previous grs.
+        """
+        grs = [ana.attrib.get(u'gr') for ana in anas]
+        if None in grs:
+            return []
+        key = (prev2WordAna, prevWordAna, frozenset(grs))
+        if key not in self.triMemo:
+            winners = set()
+            if prev2WordAna in self.grIds and prevWordAna in self.grIds:
+                prefix = self.grIds[prev2WordAna] << 42 | self.grIds[prevWordAna] << 21
+                if prefix not in self.triPrefixes:
+                    self.triPrefixes[prefix] = self.triCounts.following(prefix)
+                following = self.triPrefixes[prefix]
+                counts = dict((gr, following.get(self.grIds.get(gr), 0)) for gr in key[2])
+                best = max(counts.values())
+                winners = set(gr for gr in counts if best and counts[gr] == best)
+            self.triMemo[key] = winners
+        byGr = dict((ana.attrib[u'gr'], ana) for ana in anas)
+        order = []
+        for gr in grs:
+            if gr in self.triMemo[key] and gr not in order:
+                order.append(gr)
+        return [byGr[gr] for gr in order]
+
+    def compile_back_rules(self, freqs):
+        """
+        Compiles the frequencies into an index of the left neighbours for propagate.
+
+        Returns dictionary:
+        dictionary = {anaOfWord2: {anaOfWord1: freq, ...}, ...}
+        """
+        back = defaultdict(dict)
+        for key in freqs.iterkeys():
+            items = key.split()
+            back[items[1]][items[0]] = int(freqs[key])
+        return back
+
+    def best_anas(self, index, prevWordAna, anas):
+        """
+        Returns the anas of the word whose bigram with the previous ana prevWordAna is the most frequent,
+        in the order the search through the list of get_rules gave them.
+        The winning grs are remembered for each (prevWordAna, set of grs of the anas).
+        """
+        grs = [ana.attrib.get(u'gr') for ana in anas]
+        if None in grs:
+            return []
+        key = (prevWordAna, frozenset(grs))
+        if key not in self.memo:
+            successors = index.get(prevWordAna, {})
+            d = {}
+            for rank, gr in sorted((successors[gr][0], gr) for gr in key[1] if gr in successors):
+                d[gr] = successors[gr][1]
+            max_f = max(d.values() + [0])
+            self.memo[key] = [x for x in d.keys() if d[x] == max_f]
+        byGr = dict((ana.attrib[u'gr'], ana) for ana in anas)
+        return [byGr[gr] for gr in self.memo[key]]
+
     def check_for_special_cases(self, new_x):
         stay = ""
         decide = ""
@@ -165,7 +403,67 @@ class GoodBigramsTrainer:
         else:
             return None
 
-    def get_corpora(self, fname, check):
+    def propagate(self, se, check, back):
+        """
+        Disambiguates the words of the sentence se that are left ambiguous after the pass of get_corpora,
+        with the bigrams of both neighbours that have one ana.
+        The words next to a word that gets one ana are put on the worklist and examined again,
+        until no word changes. The anas with the greatest sum of the frequencies of the two bigrams are kept.
+        Returns the number of changes.
+        """
+        def resolved(i):
+            if 0 <= i < len(se):
+                anas = [ana for ana in se[i] if "lex" in ana.attrib]
+                if len(anas) == 1 and u'gr' in anas[0].attrib:
+                    return anas[0].attrib[u'gr']
+            return None
+
+        changes = 0
+        work = [w for w in xrange(len(se)) if len(se[w]) > 1]
+        queued = set(work)
+        while work:
+            w = work.pop()
+            queued.discard(w)
+            anas = [ana for ana in se[w]]
+            prevGr, nextGr = resolved(w - 1), resolved(w + 1)
+            if len(anas) < 2 or (prevGr is None and nextGr is None):
+                continue
+            if [ana for ana in anas if u'gr' not in ana.attrib] or self.check_for_special_cases(anas) is not None:
+                continue
+            scores = []
+            for ana in anas:
+                gr = ana.attrib[u'gr']
+                score = 0
+                if prevGr is not None and gr in check.get(prevGr, {}):
+                    score += check[prevGr][gr][1]
+                if nextGr is not None:
+                    score += back.get(nextGr, {}).get(gr, 0)
+                scores.append(score)
+            best = max(scores)
+            if best == 0 or min(scores) == best:
+                continue
+            form = anas[-1].tail
+            for ana, score in zip(anas, scores):
+                if score != best:
+                    se[w].remove(ana)
+            for ana in se[w]:
+                ana.tail = None
+            se[w][-1].tail = form
+            changes += 1
+            if resolved(w) is not None:
+                for i in (w - 1, w + 1):
+                    if 0 <= i < len(se) and len(se[i]) > 1 and i not in queued:
+                        work.append(i)
+                        queued.add(i)
+        return changes
+
+    def get_corpora(self, fname, check, back=None, trigrams=False):
+        """
+        Disambiguates the file fname with the compiled rules check and returns the new text.
+        back: the index of compile_back_rules, if it is given, the words that stay ambiguous are passed to propagate.
+        trigrams: True or False, if the value is True and the two previous words have one ana,
+                  the trigrams are tried before the bigrams (see best_trigram_anas).
+        """
 
         root = etree.parse(fname).getroot()  # get a text from the corpus
 
@@ -174,7 +472,6 @@ class GoodBigramsTrainer:
         for se in root[1]:
             for w in range(len(se)):
                 var = 0
-                max_f = 0
                 curWordAnas = [ana for ana in se[w]]  # array contains all anas of current word
                 if len(curWordAnas) > 1:  # if the word has multiple anas
                     cur_w = curWordAnas[-1].tail  # current word
@@ -197,25 +494,18 @@ class GoodBigramsTrainer:
                             for ana in se[w - 1]:
                                 prevWordAna = ana.attrib[u'gr'] # ana1
                                 # got ana of the previous word
-                            try:
-                                d = {}
-                                for possibleNextAna in check[prevWordAna]:
-                                    # look for all possible anas after the previous one
-                                    for analysis in curWordAnas:
-                                        if possibleNextAna[0] == analysis.attrib[u'gr']:
-                                            # search in the dictionary, find anas suggested by morphological parser
-                                            d[possibleNextAna[0]] = (possibleNextAna[1], analysis)  # write to the dictionary
-                                for x in d.keys():  # searching the most frequent ana
-                                    if d[x][0] > max_f:
-                                        max_f = d[x][0]
-                                for x in d.keys():
-                                    if d[x][0] == max_f:
-                                        d[x][1].tail = None
-                                        se[w].append(d[x][1])
-                                        #write best ana
-                            except KeyError:
-                                # print "No key in dictionary"
-                                pass
+                            chosen = []
+                            if trigrams and w >= 2:
+                                prev2AnaList = [ana for ana in se[w - 2] if "lex" in ana.attrib]
+                                if len(prev2AnaList) == 1 and u'gr' in prev2AnaList[0].attrib:
+                                    chosen = self.best_trigram_anas(prev2AnaList[0].attrib[u'gr'], prevWordAna,
+                                                                    curWordAnas)
+                            if not chosen:
+                                chosen = self.best_anas(check, prevWordAna, curWordAnas)
+                            for analysis in chosen:
+                                analysis.tail = None
+                                se[w].append(analysis)
+                                #write best ana
                     except KeyError:
                         # print "No previous word"
                         pass
@@ -225,18 +515,34 @@ class GoodBigramsTrainer:
                     else:
                         se[w][-1].tail = cur_w
                         changes += 1
+            if back is not None:
+                changes += self.propagate(se, check, back)
         self.changes += changes
         print "Made %s changes. Total: %s changes." %(changes, self.changes)
 
         return etree.tostring(root, pretty_print=True, encoding=unicode)
 
-    def start_apply(self, path, freq, extension=".xhtml"):
-        check = self.get_rules(freq)  # dictionary
+    def start_apply(self, path, freq, extension=".xhtml", propagate=False, trigrams=False):
+        """
+        Applies the bigrams to the files in path and rewrites them.
+        propagate: True or False, False by default,
+                   if the value is True, the words left ambiguous by the pass from left to right
+                   are disambiguated in memory with both neighbours until nothing changes (see propagate),
+                   each file is still written once.
+        trigrams: True or False, False by default,
+                  if the value is True, the counted trigrams are used where the two previous words have one ana,
+                  with the bigrams as a backoff.
+        """
+        check = self.compile_rules(freq)  # dictionary
+        back = self.compile_back_rules(freq) if propagate else None
+        self.memo = {}
+        self.triMemo = {}
+        self.triPrefixes = {}
         for root, dirs, files in os.walk(path):
             for fname in files:
                 if fname.endswith(extension):
                     print "Applying bigrams to %s" % os.path.join(root, fname)
-                    new_text = self.get_corpora(os.path.join(root, fname), check)
+                    new_text = self.get_corpora(os.path.join(root, fname), check, back, trigrams)
                     f2 = codecs.open(os.path.join(root, fname), 'w', 'utf-8')
                     header = '<?xml version="1.0" encoding="utf-8"?>\r\n'
                     f2.write(header)
@@ -244,6 +550,47 @@ class GoodBigramsTrainer:
                     f2.close()
 
 
-m = GoodBigramsTrainer('C:\\Users\\asus\PycharmProjects\yiddish\\yiddish_parsed_cases', printing=False)
-freqs = m.count_freq(printing=False)
-m.start_apply('C:\\Users\\asus\PycharmProjects\yiddish\\yiddish_parsed_cases_run_bigr\\acc', freqs)
\ No newline at end of file
+class PackedCounts:
+    """
+    Counts of n-grams packed into integer keys, kept in two sorted NumPy arrays, keys and counts.
+    The new keys are gathered in a buffer, which is merged into the arrays when it is full and by flush,
+    so the memory is bounded by the number of distinct keys and the size of the buffer.
+    The counts of the keys with a common prefix are found by binary search (see following).
+    """
+
+    def __init__(self, size=1 << 20):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.buffer = []
+        self.size = size
+
+    def add(self, key):
+        self.buffer.append(key)
+        if len(self.buffer) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        keys = np.concatenate((self.keys, np.array(self.buffer, dtype=np.int64)))
+        counts = np.concatenate((self.counts, np.ones(len(self.buffer), dtype=np.int64)))
+        order = np.argsort(keys, kind='mergesort')
+        keys, counts = keys[order], counts[order]
+        self.keys, starts = np.unique(keys, return_index=True)
+        self.counts = np.add.reduceat(counts, starts)
+        self.buffer = []
+
+    def following(self, prefix, bits=21):
+        """
+        Returns the dictionary {last id: count} of the keys that start with prefix,
+        i.e. the keys from prefix to prefix + 2 ** bits, which are found by binary search.
+        """
+        self.flush()
+        lo, hi = np.searchsorted(self.keys, [prefix, prefix + (1 << bits)]).tolist()
+        return dict(zip((self.keys[lo:hi] & ((1 << bits) - 1)).tolist(), self.counts[lo:hi].tolist()))
+
+
+if __name__ == '__main__':
+    m = GoodBigramsTrainer('C:\\Users\\asus\PycharmProjects\yiddish\\yiddish_parsed_cases', printing=False)
+    freqs = m.count_freq(printing=False)
+    m.start_apply('C:\\Users\\asus\PycharmProjects\yiddish\\yiddish_parsed_cases_run_bigr\\acc', freqs)
@@ -14,13 +14,22 @@ These are some codes for morphological ambiguity resolution in the Corpus of Yid
 I still haven't written any nice description here.
 """
 
+from __future__ import division
 __author__ = 'elmira'
 
 import os
 import re
 import time
+import heapq
 import codecs
+import random
+import cPickle
+from array import array
+import StringIO
+import multiprocessing
+import numpy as np
 from lxml import etree
+from corpus import iter_sentences, iter_corpus, corpus_files
 from collections import defaultdict
 
 
@@ -35,68 +44,217 @@ class GoodBigramsTrainer:
     Then it is possible to use this information to cope with the resting homonimy.
     """
 
-    goodBigrs = []
-
-    def __init__(self, path, extension=".xhtml", printing=False):
+    def __init__(self, path, extension=".xhtml", printing=False, trigrams=False):
         """
         Starts the search.
 
-        path: unicode string containing the path to the directory where the corpus files are stored
+        path: unicode string containing the path to the directory where the corpus files are stored,
+              or to a cache made by corpus.compile_corpus,
+              or to a model file written by save_model, then the bigrams are loaded and the corpus is not searched
         extension: unicode string containing the ending of the filename, e.g. '.xhtml' or 'cheese.txt',
                    this helps to identify files that need to be searched
         printing: True or False,
                   False by default,
                   if the value is True, all bigrams are printed to file *good_bigrams.txt*
+        trigrams: True or False,
+                  False by default,
+                  if the value is True, the trigrams of good words are counted too (see search_trigrams)
+        If path is None, the search is skipped, the bigrams are collected sentence by sentence (see collect_sentence).
+        The bigrams are not kept, only the number of each pair (gr of the word, gr of the next word) is counted.
         """
         self.changes = 0
+        self.gram = []
+        self.tri = []
+        self.memo = {}
+        self.triMemo = {}
+        self.triPrefixes = {}
+        self.trigrams = trigrams
+        self.triCounts = PackedCounts()
+        self.grIds = {}
+        self.grList = []
+        self.counts = {}  # (id of the gr of the word << 32) | id of the gr of the next word: number of bigrams
+        self.order = []  # keys of counts in the order of their first occurrence
+        self.total = 0
+        self.dump = None
+        if path is None:
+            return
+        if os.path.isfile(path):
+            self.load_model(path)
+            return
         print 'Collecting good bigrams...'
-        for root, dirs, files in os.walk(path):
-            for fName in files:
-                if fName.endswith(extension):
-                    self.search_file(os.path.join(root, fName))
-        print 'Good bigrams collected. Total: %s bigrams.\r\n' %(len(self.goodBigrs))
         if printing:
-            f = codecs.open(u"good_bigrams.txt", "a", "utf-8")
-            f.write('\r\n'.join(self.goodBigrs))
-            f.close()
+            self.dump = codecs.open(u"good_bigrams.txt", "a", "utf-8")
+        for fName, sents in iter_corpus(path, extension):
+            self.search_file(fName, sents)
+        if printing:
+            self.dump.close()
+            self.dump = None
+        print 'Good bigrams collected. Total: %s bigrams.\r\n' %(self.total)
 
-    def search_file(self, fName):
+    def search_file(self, fName, sents=None):
         """
         Performs the search of good bigrams in a given file fName.
-        Writes the result to the array goodBigrs.
+        Counts the result with add_bigrams.
+        sents: the sentences of the file if they are already read (see iter_corpus), otherwise the file is parsed.
         """
         try:
-            root = etree.parse(fName).getroot()
             gram = []
-            for se in root[1]:
-                for w in range(len(se) - 1):
-                    nextWord = [ana for ana in se[w + 1] if "lex" in ana.attrib]  # not counting empty tags
-                    curWord = [ana for ana in se[w] if "lex" in ana.attrib]
-                    nextPoS = set([x.attrib["gr"].split(u',')[0] for x in nextWord])
-                    curPoS = set([x.attrib["gr"].split(u',')[0] for x in curWord])
-                    if (curPoS == {"V", "ADV"} or curPoS == {"PREP", "PRON"} or curPoS == {"V", "PRON"}) and len(curWord) == 2:  # treating special cases right
-                        curResult = True
-                    else:
-                        curResult = False
-                    if (nextPoS == {"V", "ADV"} or nextPoS == {"PREP", "PRON"} or nextPoS == {"V", "PRON"}) and len(nextWord) == 2:
-                        nextResult = True
-                    else:
-                        nextResult = False
-                    if len(nextWord) == 1 or nextResult:
-                        if len(curWord) == 1 or curResult:
-                            gram.append((nextWord[-1].tail, nextWord[-1].attrib[u'gr'],
-                                         curWord[-1].tail, curWord[-1].attrib[u'gr']))
-            for i in gram:
-                bigramString = i[0] + ' ' + i[1] + ' ' + i[2] + ' ' + i[3]
-                self.goodBigrs.append(bigramString)
+            tri = []
+            if sents is None:
+                sents = iter_sentences(fName)
+            for sent in sents:
+                gram += self.search_sentence(sent)
+                if self.trigrams:
+                    tri += self.search_trigrams(sent)
+            self.add_bigrams(gram)
+            self.add_trigrams(tri)
+        except ValueError:
+            raise  # too many grs for the trigrams, see add_trigrams
+        except:
+            print "Class - GoodBigrams; function - search_file(filename); fail at %s" % fName
+
+    def search_sentence(self, sent):
+        """
+        Returns the good bigrams of one sentence sent, a list of (wordform, [attributes of ana, ...]).
+        Each bigram is a tuple (next word, its gr, current word, its gr).
+        """
+        gram = []
+        for w in range(len(sent) - 1):
+            nextWord = [ana for ana in sent[w + 1][1] if "lex" in ana]  # not counting empty tags
+            curWord = [ana for ana in sent[w][1] if "lex" in ana]
+            nextPoS = set([x["gr"].split(u',')[0] for x in nextWord])
+            curPoS = set([x["gr"].split(u',')[0] for x in curWord])
+            if (curPoS == {"V", "ADV"} or curPoS == {"PREP", "PRON"} or curPoS == {"V", "PRON"}) and len(curWord) == 2:  # treating special cases right
+                curResult = True
+            else:
+                curResult = False
+            if (nextPoS == {"V", "ADV"} or nextPoS == {"PREP", "PRON"} or nextPoS == {"V", "PRON"}) and len(nextWord) == 2:
+                nextResult = True
+            else:
+                nextResult = False
+            if len(nextWord) == 1 or nextResult:
+                if len(curWord) == 1 or curResult:
+                    gram.append((sent[w + 1][0], nextWord[-1][u'gr'],
+                                 sent[w][0], curWord[-1][u'gr']))
+        return gram
+
+    def good_gr(self, anas):
+        """
+        Returns the gr of a word with the attributes of its anas, if the word is good as in search_sentence, or None.
+        """
+        word = [ana for ana in anas if "lex" in ana]
+        PoS = set([x["gr"].split(u',')[0] for x in word])
+        if len(word) == 1 or ((PoS == {"V", "ADV"} or PoS == {"PREP", "PRON"} or PoS == {"V", "PRON"}) and len(word) == 2):
+            return word[-1][u'gr']
+        return None
+
+    def search_trigrams(self, sent):
+        """
+        Returns the trigrams of the good words of one sentence sent, each trigram is a tuple of their grs.
+        """
+        grs = [self.good_gr(anas) for word, anas in sent]
+        return [tuple(grs[w:w + 3]) for w in xrange(len(grs) - 2) if None not in grs[w:w + 3]]
 
+    def add_trigrams(self, tri):
+        """
+        Counts the trigrams of grs, a trigram is packed into one integer of three 21-bit gr ids,
+        so there can be no more than 2 ** 21 grs. Raises ValueError if there are more,
+        search_file and end_file let it through, so the training stops.
+        """
+        for gr1, gr2, gr3 in tri:
+            key = self.gr_id(gr1) << 42 | self.gr_id(gr2) << 21 | self.gr_id(gr3)
+            if len(self.grList) > 2 ** 21:
+                raise ValueError('too many grs to pack the trigrams: %s, the limit is 2 ** 21' % len(self.grList))
+            self.triCounts.add(key)
+
+    def add_bigrams(self, gram):
+        """
+        Counts the bigrams returned by search_sentence, and writes them to the open file dump if there is one.
+        """
+        for i in gram:
+            key = self.gr_id(i[3]) << 32 | self.gr_id(i[1])
+            if key in self.counts:
+                self.counts[key] += 1
+            else:
+                self.counts[key] = 1
+                self.order.append(key)
+            if self.dump is not None:
+                if self.total:
+                    self.dump.write('\r\n')
+                self.dump.write(i[0] + ' ' + i[1] + ' ' + i[2] + ' ' + i[3])
+            self.total += 1
+
+    def gr_id(self, gr):
+        """
+        Returns the id of gr, adds it if it is new.
+        The ids of the grs of trigrams must be below 2 ** 21 (see add_trigrams).
+        """
+        if gr not in self.grIds:
+            self.grIds[gr] = len(self.grList)
+            self.grList.append(gr)
+        return self.grIds[gr]
+
+    def start_file(self, fName):
+        """
+        Starts a new file when the bigrams are collected sentence by sentence.
+        The bigrams of the file are kept in gram until end_file, so a file that fails is dropped as in search_file.
+        """
+        self.gram = []
+        self.tri = []
+
+    def collect_sentence(self, sent):
+        if self.gram is not None:
+            try:
+                self.gram += self.search_sentence(sent)
+                if self.trigrams:
+                    self.tri += self.search_trigrams(sent)
+            except:
+                self.gram = None
+
+    def end_file(self, fName):
+        try:
+            self.add_bigrams(self.gram)
+            self.add_trigrams(self.tri)
+        except ValueError:
+            raise  # too many grs for the trigrams, see add_trigrams
         except:
             print "Class - GoodBigrams; function - search_file(filename); fail at %s" % fName
+        self.gram = []
+        self.tri = []
+
+    def save_model(self, path):
+        """
+        Writes the counted bigrams to the file path as NumPy arrays:
+        grs - the grs by their ids, keys - the keys of counts in the order of their first occurrence, counts,
+        tri_keys and tri_counts - the counted trigrams (see PackedCounts).
+        """
+        f = open(path, 'wb')
+        self.triCounts.flush()
+        np.savez(f, grs=np.array(self.grList, dtype=np.unicode_), keys=np.array(self.order, dtype=np.int64),
+                 counts=np.array([self.counts[key] for key in self.order], dtype=np.int64),
+                 total=np.array([self.total], dtype=np.int64),
+                 tri_keys=self.triCounts.keys, tri_counts=self.triCounts.counts)
+        f.close()
+
+    def load_model(self, path):
+        """
+        Reads the bigrams written by save_model, count_freq then gives the same frequencies.
+        """
+        model = np.load(path)
+        self.grList = model['grs'].tolist()
+        self.grIds = dict((self.grList[i], i) for i in xrange(len(self.grList)))
+        self.order = model['keys'].tolist()
+        self.counts = dict(zip(self.order, model['counts'].tolist()))
+        self.total = int(model['total'][0])
+        if 'tri_keys' in model.files:
+            self.triCounts.keys, self.triCounts.counts = model['tri_keys'], model['tri_counts']
+        model.close()
+        print 'Good bigrams loaded from %s. Total: %s bigrams.\r\n' % (path, self.total)
 
     def count_freq(self, printing=False):
         """
-        Opens array with bigrams and counts frequency for each bigram.
-        Returns a dictionary { bigram:frequency }.
+        Turns the counted bigrams into a dictionary { bigram:frequency }, where a bigram is 'ana1 ana2',
+        the bigrams are inserted in the order of their first occurrence.
 
         printing: True or False,
                   False by default,
@@ -105,12 +263,8 @@ class GoodBigramsTrainer:
         """
         print 'Counting frequencies...\r\n'
         d = defaultdict(int)
-        for line in self.goodBigrs:
-            line = line.split()
-            k = line[3] + ' ' + line[1]
-            # if k not in d:
-            #     print k
-            d[k] += 1
+        for key in self.order:
+            d[self.grList[key >> 32] + ' ' + self.grList[key & 0xFFFFFFFF]] = self.counts[key]
         if printing:
             f2 = codecs.open(u"good_bigrams_frequency_morpho.txt", "w", "utf-8")
             # writes "ana1 ana2" freq
@@ -135,6 +289,87 @@ class GoodBigramsTrainer:
             d[items[0]].append((items[1], int(items[2])))
         return d
 
+    def compile_rules(self, freqs):
+        """
+        Compiles the rules of get_rules into an index for get_corpora.
+
+        Returns dictionary:
+        dictionary = {anaOfWord1: {anaOfWord2: (place in the list of get_rules, freq), ...}, ...}
+        """
+        index = {}
+        rules = self.get_rules(freqs)
+        for prev in rules:
+            successors = index[prev] = {}
+            for rank in xrange(len(rules[prev])):
+                gr, freq = rules[prev][rank]
+                if gr in successors:
+                    successors[gr] = (successors[gr][0], freq)
+                else:
+                    successors[gr] = (rank, freq)
+        return index
+
+    def best_trigram_anas(self, prev2WordAna, prevWordAna, anas):
+        """
+        Returns the anas of the word whose trigram with the two previous anas is the most frequent,
+        or an empty list if none of the trigrams was counted.
+        The winning grs are remembered for each (prev2WordAna, prevWordAna, set of grs of the anas),
+        and the counted trigrams for each pair of previous grs.
+        """
+        grs = [ana.attrib.get(u'gr') for ana in anas]
+        if None in grs:
+            return []
+        key = (prev2WordAna, prevWordAna, frozenset(grs))
+        if key not in self.triMemo:
+            winners = set()
+            if prev2WordAna in self.grIds and prevWordAna in self.grIds:
+                prefix = self.grIds[prev2WordAna] << 42 | self.grIds[prevWordAna] << 21
+                if prefix not in self.triPrefixes:
+                    self.triPrefixes[prefix] = self.triCounts.following(prefix)
+                following = self.triPrefixes[prefix]
+                counts = dict((gr, following.get(self.grIds.get(gr), 0)) for gr in key[2])
+                best = max(counts.values())
+                winners = set(gr for gr in counts if best and counts[gr] == best)
+            self.triMemo[key] = winners
+        byGr = dict((ana.attrib[u'gr'], ana) for ana in anas)
+        order = []
+        for gr in grs:
+            if gr in self.triMemo[key] and gr not in order:
+                order.append(gr)
+        return [byGr[gr] for gr in order]
+
+    def compile_back_rules(self, freqs):
+        """
+        Compiles the frequencies into an index of the left neighbours for propagate.
+
+        Returns dictionary:
+        dictionary = {anaOfWord2: {anaOfWord1: freq, ...}, ...}
+        """
+        back = defaultdict(dict)
+        for key in freqs.iterkeys():
+            items = key.split()
+            back[items[1]][items[0]] = int(freqs[key])
+        return back
+
+    def best_anas(self, index, prevWordAna, anas):
+        """
+        Returns the anas of the word whose bigram with the previous ana prevWordAna is the most frequent,
+        in the order the search through the list of get_rules gave them.
+        The winning grs are remembered for each (prevWordAna, set of grs of the anas).
+        """
+        grs = [ana.attrib.get(u'gr') for ana in anas]
+        if None in grs:
+            return []
+        key = (prevWordAna, frozenset(grs))
+        if key not in self.memo:
+            successors = index.get(prevWordAna, {})
+            d = {}
+            for rank, gr in sorted((successors[gr][0], gr) for gr in key[1] if gr in successors):
+                d[gr] = successors[gr][1]
+            max_f = max(d.values() + [0])
+            self.memo[key] = [x for x in d.keys() if d[x] == max_f]
+        byGr = dict((ana.attrib[u'gr'], ana) for ana in anas)
+        return [byGr[gr] for gr in self.memo[key]]
+
     def check_for_special_cases(self, new_x):
         stay = ""
         decide = ""
@@ -157,7 +392,67 @@ class GoodBigramsTrainer:
         else:
             return None
 
-    def get_corpora(self, fname, check):
+    def propagate(self, se, check, back):
+        """
+        Disambiguates the words of the sentence se that are left ambiguous after the pass of get_corpora,
+        with the bigrams of both neighbours that have one ana.
+        The words next to a word that gets one ana are put on the worklist and examined again,
+        until no word changes. The anas with the greatest sum of the frequencies of the two bigrams are kept.
+        Returns the number of changes.
+        """
+        def resolved(i):
+            if 0 <= i < len(se):
+                anas = [ana for ana in se[i] if "lex" in ana.attrib]
+                if len(anas) == 1 and u'gr' in anas[0].attrib:
+                    return anas[0].attrib[u'gr']
+            return None
+
+        changes = 0
+        work = [w for w in xrange(len(se)) if len(se[w]) > 1]
+        queued = set(work)
+        while work:
+            w = work.pop()
+            queued.discard(w)
+            anas = [ana for ana in se[w]]
+            prevGr, nextGr = resolved(w - 1), resolved(w + 1)
+            if len(anas) < 2 or (prevGr is None and nextGr is None):
+                continue
+            if [ana for ana in anas if u'gr' not in ana.attrib] or self.check_for_special_cases(anas) is not None:
+                continue
+            scores = []
+            for ana in anas:
+                gr = ana.attrib[u'gr']
+                score = 0
+                if prevGr is not None and gr in check.get(prevGr, {}):
+                    score += check[prevGr][gr][1]
+                if nextGr is not None:
+                    score += back.get(nextGr, {}).get(gr, 0)
+                scores.append(score)
+            best = max(scores)
+            if best == 0 or min(scores) == best:
+                continue
+            form = anas[-1].tail
+            for ana, score in zip(anas, scores):
+                if score != best:
+                    se[w].remove(ana)
+            for ana in se[w]:
+                ana.tail = None
+            se[w][-1].tail = form
+            changes += 1
+            if resolved(w) is not None:
+                for i in (w - 1, w + 1):
+                    if 0 <= i < len(se) and len(se[i]) > 1 and i not in queued:
+                        work.append(i)
+                        queued.add(i)
+        return changes
+
+    def get_corpora(self, fname, check, back=None, trigrams=False):
+        """
+        Disambiguates the file fname with the compiled rules check and returns the new text.
+        back: the index of compile_back_rules, if it is given, the words that stay ambiguous are passed to propagate.
+        trigrams: True or False, if the value is True and the two previous words have one ana,
+                  the trigrams are tried before the bigrams (see best_trigram_anas).
+        """
 
         root = etree.parse(fname).getroot()  # get a text from the corpus
 
@@ -166,7 +461,6 @@ class GoodBigramsTrainer:
         for se in root[1]:
             for w in range(len(se)):
                 var = 0
-                max_f = 0
                 curWordAnas = [ana for ana in se[w]]  # array contains all anas of current word
                 if len(curWordAnas) > 1:  # if the word has multiple anas
                     cur_w = curWordAnas[-1].tail  # current word
@@ -189,25 +483,18 @@ class GoodBigramsTrainer:
                             for ana in se[w - 1]:
                                 prevWordAna = ana.attrib[u'gr'] # ana1
                                 # got ana of the previous word
-                            try:
-                                d = {}
-                                for possibleNextAna in check[prevWordAna]:
-                                    # look for all possible anas after the previous one
-                                    for analysis in curWordAnas:
-                                        if possibleNextAna[0] == analysis.attrib[u'gr']:
-                                            # search in the dictionary, find anas suggested by morphological parser
-                                            d[possibleNextAna[0]] = (possibleNextAna[1], analysis)  # write to the dictionary
-                                for x in d.keys():  # searching the most frequent ana
-                                    if d[x][0] > max_f:
-                                        max_f = d[x][0]
-                                for x in d.keys():
-                                    if d[x][0] == max_f:
-                                        d[x][1].tail = None
-                                        se[w].append(d[x][1])
-                                        #write best ana
-                            except KeyError:
-                                # print "No key in dictionary"
-                                pass
+                            chosen = []
+                            if trigrams and w >= 2:
+                                prev2AnaList = [ana for ana in se[w - 2] if "lex" in ana.attrib]
+                                if len(prev2AnaList) == 1 and u'gr' in prev2AnaList[0].attrib:
+                                    chosen = self.best_trigram_anas(prev2AnaList[0].attrib[u'gr'], prevWordAna,
+                                                                    curWordAnas)
+                            if not chosen:
+                                chosen = self.best_anas(check, prevWordAna, curWordAnas)
+                            for analysis in chosen:
+                                analysis.tail = None
+                                se[w].append(analysis)
+                                #write best ana
                     except KeyError:
                         # print "No previous word"
                         pass
@@ -217,18 +504,34 @@ class GoodBigramsTrainer:
                     else:
                         se[w][-1].tail = cur_w
                         changes += 1
+            if back is not None:
+                changes += self.propagate(se, check, back)
         self.changes += changes
         print "Made %s changes. Total: %s changes." %(changes, self.changes)
 
         return etree.tostring(root, pretty_print=True, encoding=unicode)
 
-    def start_apply(self, path, freq, extension=".xhtml"):
-        check = self.get_rules(freq)  # dictionary
+    def start_apply(self, path, freq, extension=".xhtml", propagate=False, trigrams=False):
+        """
+        Applies the bigrams to the files in path and rewrites them.
+        propagate: True or False, False by default,
+                   if the value is True, the words left ambiguous by the pass from left to right
+                   are disambiguated in memory with both neighbours until nothing changes (see propagate),
+                   each file is still written once.
+        trigrams: True or False, False by default,
+                  if the value is True, the counted trigrams are used where the two previous words have one ana,
+                  with the bigrams as a backoff.
+        """
+        check = self.compile_rules(freq)  # dictionary
+        back = self.compile_back_rules(freq) if propagate else None
+        self.memo = {}
+        self.triMemo = {}
+        self.triPrefixes = {}
         for root, dirs, files in os.walk(path):
             for fname in files:
                 if fname.endswith(extension):
                     print "Applying bigrams to %s" % os.path.join(root, fname)
-                    new_text = self.get_corpora(os.path.join(root, fname), check)
+                    new_text = self.get_corpora(os.path.join(root, fname), check, back, trigrams)
                     f2 = codecs.open(os.path.join(root, fname), 'w', 'utf-8')
                     header = '<?xml version="1.0" encoding="utf-8"?>\r\n'
                     f2.write(header)
@@ -236,6 +539,46 @@ class GoodBigramsTrainer:
                     f2.close()
 
 
+class PackedCounts:
+    """
+    Counts of n-grams packed into integer keys, kept in two sorted NumPy arrays, keys and counts.
+    The new keys are gathered in a buffer, which is merged into the arrays when it is full and by flush,
+    so the memory is bounded by the number of distinct keys and the size of the buffer.
+    The counts of the keys with a common prefix are found by binary search (see following).
+    """
+
+    def __init__(self, size=1 << 20):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.buffer = []
+        self.size = size
+
+    def add(self, key):
+        self.buffer.append(key)
+        if len(self.buffer) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        keys = np.concatenate((self.keys, np.array(self.buffer, dtype=np.int64)))
+        counts = np.concatenate((self.counts, np.ones(len(self.buffer), dtype=np.int64)))
+        order = np.argsort(keys, kind='mergesort')
+        keys, counts = keys[order], counts[order]
+        self.keys, starts = np.unique(keys, return_index=True)
+        self.counts = np.add.reduceat(counts, starts)
+        self.buffer = []
+
+    def following(self, prefix, bits=21):
+        """
+        Returns the dictionary {last id: count} of the keys that start with prefix,
+        i.e. the keys from prefix to prefix + 2 ** bits, which are found by binary search.
+        """
+        self.flush()
+        lo, hi = np.searchsorted(self.keys, [prefix, prefix + (1 << bits)]).tolist()
+        return dict(zip((self.keys[lo:hi] & ((1 << bits) - 1)).tolist(), self.counts[lo:hi].tolist()))
+
+
 #************************************#
 # Disambiguation - Brill             #
 #************************************#
@@ -255,23 +598,165 @@ class BrillTrainer:
     Part of Speech Disambiguation with Transformation-Based Learning.
     Has four templates checking 1 word or tag before or after the current word.
     Initializes with a directory with corpus files for generating transformations and ending of the files.
+
+    The corpus is kept as two parallel arrays of word ids and tag ids (words and tags),
+    sentStarts holds the position of the first word of each sentence and one more position after the last word.
+    wordList and tagList give the strings for the ids.
+    positions is an index from each tag id to the positions of the words with the tag, sentOf gives the sentence
+    of each position, both are built by index_positions and kept up to date by apply_transformation.
     """
 
     nums = 0
     orderedList = []
     frequencies = defaultdict(int)
+    vectorized = False
+    defaultTemplates = [(-1, 'tag'), (+1, 'tag'), (-1, 'word'), (+1, 'word')]
+    extendedTemplates = [(-1, 'tag'), (+1, 'tag'), (-2, 'tag'), (+2, 'tag'),
+                         (-1, 'word'), (+1, 'word'), (-2, 'word'), (+2, 'word'),
+                         (-2, 'anytag'), (+2, 'anytag'), (-1, 'wordtag'), (+1, 'wordtag')]
 
     def __init__(self):
         print "BrillTrainer instance created."
-        self.corpus = []
+        self.wordIds = {}
+        self.wordList = []
+        self.tagIds = {}
+        self.tagList = []
+        self.words = array('i')
+        self.tags = array('i')
+        self.sentStarts = array('l', [0])
+        self.positions = defaultdict(set)
+        self.sentOf = array('l')
+        self.instances = None
         self.changes = 0
 
+    def get_id(self, ids, values, value):
+        """
+        Returns the id of value in the vocabulary ids (wordIds or tagIds), adds the value if it is new.
+        """
+        if value not in ids:
+            ids[value] = len(values)
+            values.append(value)
+        return ids[value]
+
+    def index_positions(self):
+        """
+        Builds the index from each tag id to its positions and the sentence number of each position.
+        """
+        self.positions = defaultdict(set)
+        self.sentOf = array('l')
+        starts = self.sentStarts
+        for se in xrange(len(starts) - 1):
+            self.sentOf.extend([se] * (starts[se + 1] - starts[se]))
+        for i in xrange(len(self.tags)):
+            self.positions[self.tags[i]].add(i)
+        self.instances = None
+
+    #WEIGHTED INSTANCES
+    # An instance is the local context of a word (previous word, previous tag, tag, next tag, next word),
+    # -1 stands for the border of the sentence. The words with the same context are kept together,
+    # the number of its positions is the weight of an instance.
+
+    def index_instances(self):
+        """
+        Collapses the words of the corpus into instances:
+        instances {instance: set of positions}, instanceFirst {instance: first position},
+        tagInstances {tag id: set of instances}, instanceOf - the instance of each position.
+        """
+        self.index_positions()
+        self.instances = {}
+        self.instanceFirst = {}
+        self.tagInstances = defaultdict(set)
+        self.instanceOf = [None] * len(self.tags)
+        for i in xrange(len(self.tags)):
+            self.add_instance(i)
+
+    def instance_key(self, i):
+        starts = self.sentStarts
+        s = self.sentOf[i]
+        prev = (self.words[i - 1], self.tags[i - 1]) if i > starts[s] else (-1, -1)
+        next = (self.tags[i + 1], self.words[i + 1]) if i < starts[s + 1] - 1 else (-1, -1)
+        return prev + (self.tags[i],) + next
+
+    def add_instance(self, i):
+        key = self.instance_key(i)
+        if key not in self.instances:
+            self.instances[key] = set()
+            self.instanceFirst[key] = i
+            self.tagInstances[key[2]].add(key)
+        elif i < self.instanceFirst[key]:
+            self.instanceFirst[key] = i
+        self.instances[key].add(i)
+        self.instanceOf[i] = key
+
+    def remove_instance(self, i):
+        key = self.instanceOf[i]
+        positions = self.instances[key]
+        positions.remove(i)
+        if not positions:
+            del self.instances[key], self.instanceFirst[key]
+            self.tagInstances[key[2]].remove(key)
+        elif self.instanceFirst[key] == i:
+            self.instanceFirst[key] = min(positions)
+
+    def update_instances(self, changed):
+        """
+        Moves the changed positions and their neighbours to their new instances.
+        """
+        starts = self.sentStarts
+        affected = set()
+        for i in changed:
+            s = self.sentOf[i]
+            affected.update(xrange(max(starts[s], i - 1), min(starts[s + 1] - 1, i + 1) + 1))
+        for j in sorted(affected):
+            if self.instance_key(j) != self.instanceOf[j]:
+                self.remove_instance(j)
+                self.add_instance(j)
+
+    def apply_to_instances(self, fromTag, toTag, nums, types, key):
+        """
+        Applies the transformation to the positions of the instances that match it, as apply_transformation does.
+        Returns the list of changed positions, or None if the rule can change its own contexts on the way
+        (the previous tag is fromTag or toTag, or the previous word is changed), then each position has to be visited.
+        """
+        if nums not in (-1, 1) or types not in ('tag', 'word'):
+            return None
+        if nums == -1 and types == 'tag' and self.tagList[key] in (fromTag, toTag):
+            return None
+        field = {(-1, 'word'): 0, (-1, 'tag'): 1, (1, 'tag'): 3, (1, 'word'): 4}[(nums, types)]
+        fromId = self.tagIds[fromTag]
+        matched = []
+        for instance in self.tagInstances[fromId]:
+            if instance[field] == key:
+                matched.extend(self.instances[instance])
+        words, tags = self.words, self.tags
+        results = [(i,) + self.transform_token(words[i], fromTag, toTag) for i in sorted(matched)]
+        if nums == -1 and types == 'word' and [i for i, w, t in results if w != words[i]]:
+            return None
+        changed = []
+        for i, w, t in results:
+            if (w, t) != (words[i], fromId):
+                changed.append(i)
+            if t != fromId:
+                self.positions[fromId].remove(i)
+                self.positions[t].add(i)
+            words[i], tags[i] = w, t
+        return changed
+
+    def corpus_lines(self):
+        """
+        Returns the corpus as a list of sentences, each sentence is a string of 'word/TAG' separated by spaces.
+        """
+        words, tags, starts = self.words, self.tags, self.sentStarts
+        return [' '.join(self.wordList[words[i]] + '/' + self.tagList[tags[i]] for i in xrange(starts[s], starts[s + 1]))
+                for s in xrange(len(starts) - 1)]
+
     def make_POS_file(self, path, extension=".xhtml", printing=False):
         """
         Takes a directory with corpus xhtml-files and makes one huge txt out of all texts.
         All words in the united document have POS-tags.
 
-        path: unicode string containing the path to the directory where the corpus files are stored
+        path: unicode string containing the path to the directory where the corpus files are stored,
+              or to a cache made by corpus.compile_corpus
         extension: unicode string containing the ending of the filename, e.g. '.xhtml' or 'cheese.txt',
                    this helps to identify files that need to be searched
         printing: True or False,
@@ -280,52 +765,66 @@ class BrillTrainer:
         """
         self.nums = 0
         print 'BrillTrainer instance. Creating txt version of corpus with POS-tags...'
-        for root, dirs, files in os.walk(path):
-            for fname in files:
-                if fname.endswith(extension):
-                    self.transform_file(os.path.join(root, fname))
-                    print '    ', fname, 'found %s words so far' % self.nums
+        for fname, sents in iter_corpus(path, extension):
+            self.transform_file(fname, sents)
+            print '    ', os.path.basename(fname), 'found %s words so far' % self.nums
         print 'Corpus created.\r\n'
         if printing:
             fOut = codecs.open('corpus.txt', 'a', 'utf-8-sig')
-            fOut.write('\r\n'.join(self.corpus))
+            fOut.write('\r\n'.join(self.corpus_lines()))
             fOut.close()
 
-    def transform_file(self, fname):
+    def transform_file(self, fname, sents=None):
         """
         Takes one file and adds its content to the unified document.
+        sents: the sentences of the file if they are already read (see iter_corpus), otherwise the file is parsed.
         """
-        root = etree.parse(fname).getroot()  # get a text from the corpus
-        for se in root[1]:
-            sent = u''
-            for w in xrange(len(se)):
-                curWord = se[w][-1].tail
-                if curWord is None:
-                    curWord = ''
-                new_x = [ana for ana in se[w]]
-                for i in xrange(len(se[w])):  # ==for ana in word:
-                    se[w].remove(se[w][0])  # deleted all ana from the tree
-                for i in xrange(len(new_x)):
-                    try:
-                        new_x[i] = new_x[i].attrib['gr']
-                        if new_x[i].startswith("PRON") or new_x[i].startswith("V"):
-                            new_x[i] = ':'.join(new_x[i].split(',')[:2])
-                        else:
-                            new_x[i] = new_x[i].split(',')[0]
-                        new_x[i] = re.sub(r"\?", "", new_x[i])
-                    except:
-                        new_x[i] = 'ND'
-                new_x = list(set(new_x))
-                tag = "_".join(sorted(new_x))
-                tag = re.sub("PREP_PRON:A", "PREP+PRON:A", tag)
-                tag = re.sub("ADV_V", "ADV+V", tag)
-                tag = re.sub("PRON_V", "PRON+V", tag)
-                curWord += '/' + tag + ' '
-                sent += curWord
-                self.nums += 1
-            self.corpus.append(sent)
-
-    def run_brill(self, printRules=False, printCorp=False, maximum=500):
+        if sents is None:
+            sents = iter_sentences(fname)
+        for words in sents:
+            self.transform_sentence(words)
+
+    def transform_sentence(self, words):
+        """
+        Adds one sentence to the unified document.
+        words: list of (wordform, [attributes of ana, ...]) as yielded by iter_sentences.
+        """
+        for curWord, anas in words:
+            if curWord is None:
+                curWord = ''
+            new_x = anas[:]
+            for i in xrange(len(new_x)):
+                try:
+                    new_x[i] = new_x[i]['gr']
+                    if new_x[i].startswith("PRON") or new_x[i].startswith("V"):
+                        new_x[i] = ':'.join(new_x[i].split(',')[:2])
+                    else:
+                        new_x[i] = new_x[i].split(',')[0]
+                    new_x[i] = re.sub(r"\?", "", new_x[i])
+                except:
+                    new_x[i] = 'ND'
+            new_x = list(set(new_x))
+            tag = "_".join(sorted(new_x))
+            tag = re.sub("PREP_PRON:A", "PREP+PRON:A", tag)
+            tag = re.sub("ADV_V", "ADV+V", tag)
+            tag = re.sub("PRON_V", "PRON+V", tag)
+            self.words.append(self.get_id(self.wordIds, self.wordList, curWord.strip()))
+            self.tags.append(self.get_id(self.tagIds, self.tagList, tag))
+            self.nums += 1
+        self.sentStarts.append(len(self.tags))
+
+    def start_file(self, fname):
+        pass
+
+    def collect_sentence(self, words):
+        self.transform_sentence(words)
+
+    def end_file(self, fname):
+        print '    ', os.path.basename(fname), 'found %s words so far' % self.nums
+
+    def run_brill(self, printRules=False, printCorp=False, maximum=500, incremental=False, workers=1, templates=None,
+                  sample=None, seed=0, checkpoint=None, every=50, resume_from=None, weighted=False,
+                  vectorized=False):
         """
         Starts brill disambiguation algorithm.
         Returns ordered list of transformations.
@@ -335,21 +834,88 @@ class BrillTrainer:
         printCorp: True or False, False by default,
                     if the value is True, the transformed POS-tagged document is printed to file
                     *corpus-transformed.txt*
+        incremental: True or False, False by default,
+                     if the value is True, the counts are kept in a BrillIndex and only updated where the rules change
+                     the corpus, instead of being recounted over the whole corpus on every iteration.
+                     The learned transformations are the same.
+        workers: number of processes that score the candidate transformations, 1 by default,
+                 if it is greater than 1, a BrillPool is started once and the fromTags are spread over it
+                 on every iteration (see get_best_transform_parallel), the learned transformations are the same.
+                 Is not used with incremental=True.
+        templates: list of templates (nums, types) to learn with instead of the four default ones,
+                   e.g. self.extendedTemplates (see the context_ methods for the types).
+                   The contexts are then counted for every word by TemplateCounts,
+                   incremental and workers are not used.
+        sample: number of words, None by default,
+                if it is given, the candidates are drawn on every iteration from a random sample of this many words
+                and only the best of them are scored on the whole corpus (see SampledCounts),
+                this is much faster on a large corpus, but the transformations may differ from the exhaustive ones
+                (see compare_training). incremental and workers are not used.
+        seed: seed of the random sample.
+        checkpoint: path of a file, None by default,
+                    if it is given, the transformations and the transformed corpus are saved to it
+                    every `every` transformations and at the end (see save_checkpoint).
+        resume_from: path of a checkpoint or of a list of transformations, None by default,
+                     if it is given, the learning continues from the checkpoint,
+                     or the transformations of the list are applied to the corpus without being scored again.
+                     maximum includes these transformations.
+        weighted: True or False, False by default,
+                  if the value is True, the words with the same local context are collapsed into weighted instances
+                  (see index_instances), so the counting and most transformations take time proportional
+                  to the number of distinct contexts, not of the words. The learned transformations are the same.
+                  Is used with the default templates when incremental is False.
+        vectorized: True or False, False by default,
+                    if the value is True, freq counts the tags and the contexts with NumPy (see freq_numpy).
+                    The learned transformations are the same.
         """
-        corpus = self.corpus
+        self.vectorized = vectorized
+        if resume_from is not None:
+            if not os.path.exists(resume_from) and os.path.exists(resume_from + '.tmp'):
+                resume_from += '.tmp'  # see save_checkpoint
+            if self.is_checkpoint(resume_from):
+                self.load_checkpoint(resume_from)
+            else:
+                self.warm_start(resume_from)
         print 'Collecting transformations... ', time.asctime()
-        templates = [(-1, 'tag'), (+1, 'tag'), (-1, 'word'), (+1, 'word')]
-        while True:
-            self.frequencies = self.freq(corpus)
-            bestTransform = self.get_best_transform(templates)
-            if not (bestTransform.score > 0):
-                break
-            corpus = self.apply_transformation(bestTransform, corpus)
-            self.orderedList.append(bestTransform.rule)
-            if len(self.orderedList) >= maximum:
-                break
-            if len(self.orderedList) % 100 == 0:
-                print 'Found %s transformations so far.' % len(self.orderedList)
+        index = None
+        if sample is not None:
+            index = SampledCounts(self, templates or self.defaultTemplates, sample, seed)
+        elif templates is not None:
+            index = TemplateCounts(self, templates)
+        else:
+            templates = self.defaultTemplates
+            if incremental:
+                index = BrillIndex(self)
+            elif weighted:
+                self.index_instances()
+        learned = set(self.orderedList)
+        pool = None
+        if index is None and workers > 1:
+            pool = BrillPool(workers)
+        try:
+            while len(self.orderedList) < maximum:
+                if index is not None:
+                    bestTransform = index.get_best_transform(templates, learned)
+                else:
+                    self.frequencies = self.freq()
+                    bestTransform = self.get_best_transform(templates, workers, pool)
+                if not (bestTransform.score > 0):
+                    break
+                if index is not None:
+                    index.apply_transformation(bestTransform)
+                    learned.add(bestTransform.rule)
+                else:
+                    self.apply_transformation(bestTransform)
+                self.orderedList.append(bestTransform.rule)
+                if len(self.orderedList) % 100 == 0:
+                    print 'Found %s transformations so far.' % len(self.orderedList)
+                if checkpoint is not None and len(self.orderedList) % every == 0:
+                    self.save_checkpoint(checkpoint)
+        finally:
+            if pool is not None:
+                pool.close()
+        if checkpoint is not None:
+            self.save_checkpoint(checkpoint)
         print 'Ready. Collected all transformations.', time.asctime()
         print 'Found %s transformations.\r\n' % len(self.orderedList)
         if printRules:
@@ -358,15 +924,121 @@ class BrillTrainer:
             transformOut.close()
         if printCorp:
             corpusOut = codecs.open(u'corpus-transformed.txt', 'w', 'utf-8-sig')
-            corpusOut.write('\r\n'.join(corpus))
+            corpusOut.write('\r\n'.join(self.corpus_lines()))
             corpusOut.close()
         return self.orderedList
 
-    def get_best_transform(self, templates):
+    #CHECKPOINTS
+
+    def save_checkpoint(self, path):
+        """
+        Saves the learned transformations and the current state of the corpus to the file path.
+        The file is written under a temporary name and then renamed, so a crash never leaves a broken checkpoint.
+        On Windows the old file has to be removed before the rename, if the crash comes in between,
+        only the temporary file path + '.tmp' is left, and run_brill resumes from it.
+        """
+        state = {'orderedList': list(self.orderedList), 'words': self.words, 'tags': self.tags,
+                 'sentStarts': self.sentStarts, 'wordList': self.wordList, 'tagList': self.tagList}
+        tmp = path + '.tmp'
+        f = open(tmp, 'wb')
+        cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)  # os.rename does not replace files on Windows
+        os.rename(tmp, path)
+
+    def is_checkpoint(self, path):
+        f = open(path, 'rb')
+        start = f.read(2)
+        f.close()
+        return start == '\x80\x02'  # pickle protocol 2
+
+    def load_checkpoint(self, path):
+        """
+        Restores the transformations and the corpus saved by save_checkpoint.
+        """
+        f = open(path, 'rb')
+        state = cPickle.load(f)
+        f.close()
+        self.orderedList = state['orderedList']
+        self.words, self.tags, self.sentStarts = state['words'], state['tags'], state['sentStarts']
+        self.wordList, self.tagList = state['wordList'], state['tagList']
+        self.wordIds = dict((self.wordList[i], i) for i in xrange(len(self.wordList)))
+        self.tagIds = dict((self.tagList[i], i) for i in xrange(len(self.tagList)))
+        self.index_positions()
+        print 'Resumed from %s with %s transformations.' % (path, len(self.orderedList))
+
+    def warm_start(self, path):
+        """
+        Applies the transformations from the file path (see open_transformations) to the corpus
+        and adds them to the ordered list, as if they had been learned.
+        """
+        self.orderedList = list(self.orderedList)
+        self.index_positions()
+        for rule in self.open_transformations(path):
+            if not rule or rule in self.orderedList:
+                continue
+            parts = rule.split('\t')
+            if len(parts) == 4:  # the empty context is lost by strip
+                parts.append(u'')
+            fromTag, toTag, nums, types, item = parts
+            transform = Transformation()
+            transform.rule = rule
+            transform.meta = (fromTag, toTag, (int(nums), types, item))
+            self.apply_transformation(transform)
+            self.orderedList.append(rule)
+        print 'Started from %s with %s transformations.' % (path, len(self.orderedList))
+
+    def compare_training(self, sample, maximum=500, templates=None, seed=0, printing=False):
+        """
+        Learns the transformations twice from the same corpus: exhaustively with TemplateCounts and with a sample
+        (see run_brill), and reports how the results differ.
+        Both runs count the contexts of every word, so the difference comes only from the sampling.
+        The corpus is left as the sampled run has transformed it.
+        Returns a dictionary with the report.
+
+        printing: True or False, False by default,
+                  if the value is True, the report is printed to file *sampled-training-report.txt*
+        """
+        templates = templates or self.defaultTemplates
+        words, tags = array('i', self.words), array('i', self.tags)
+        results = []
+        for options in ({'templates': templates}, {'templates': templates, 'sample': sample, 'seed': seed}):
+            self.words, self.tags = array('i', words), array('i', tags)
+            self.index_positions()
+            self.orderedList = []
+            start = time.time()
+            rules = list(self.run_brill(maximum=maximum, **options))
+            results.append((rules, time.time() - start, self.tags))
+        (exhaustive, exTime, exTags), (sampled, saTime, saTags) = results
+        ambiguous = [i for i in xrange(len(tags)) if '_' in self.tagList[tags[i]]]
+        prefix = 0
+        while prefix < min(len(exhaustive), len(sampled)) and exhaustive[prefix] == sampled[prefix]:
+            prefix += 1
+        report = {'exhaustive rules': len(exhaustive),
+                  'sampled rules': len(sampled),
+                  'common rules': len(set(exhaustive) & set(sampled)),
+                  'same first rules': prefix,
+                  'exhaustive seconds': round(exTime, 2),
+                  'sampled seconds': round(saTime, 2),
+                  'ambiguous words': len(ambiguous),
+                  'same tags': sum(1 for i in ambiguous if exTags[i] == saTags[i])}
+        lines = ['%s: %s' % (key, report[key]) for key in sorted(report)]
+        print '\r\n'.join(lines) + '\r\n'
+        if printing:
+            reportOut = codecs.open(u'sampled-training-report.txt', 'w', 'utf-8-sig')
+            reportOut.write('\r\n'.join(lines + [u''] + [u'only exhaustive\t' + rule for rule in exhaustive if rule not in sampled] +
+                                        [u'only sampled\t' + rule for rule in sampled if rule not in exhaustive]))
+            reportOut.close()
+        return report
+
+    def get_best_transform(self, templates, workers=1, pool=None):
         """
         Iterates over all templates and returns the best transformation for the current state of the corpus.
         """
         # print 'function get_best_transform', time.asctime()
+        if workers > 1:
+            return self.get_best_transform_parallel(templates, workers, pool)
         best = Transformation()
         for template in templates:
             curTransform = self.get_best_instance(template)
@@ -374,6 +1046,45 @@ class BrillTrainer:
                 best = curTransform
         return best
 
+    def get_best_transform_parallel(self, templates, workers, pool=None):
+        """
+        Returns the same transformation as get_best_transform, the candidates are scored in a pool of processes.
+
+        The fromTags of each template are split into chunks, the workers of the pool keep their own copies
+        of the frequency tables, and get only the tables that changed since the previous iteration (see BrillPool),
+        every worker returns the best transformation of its chunk.
+        The results are taken in the order of the templates and the chunks, and a later one wins only
+        if its score is higher, so the ties are broken as in the serial search.
+        The fromTags of each template are listed here, because estimate adds the missing tags to the frequencies
+        and this changes the order of the keys for the next template.
+        If no pool is given, one is started for this call only.
+        """
+        tasks = []
+        tags = set()
+        for template in templates:
+            fromTags = self.open_fromTags()
+            for fromTag in fromTags:
+                tags.add(fromTag)
+                if self.generate_context(fromTag, template):
+                    for tag in fromTag.split('_'):
+                        self.frequencies[0][tag] += 0
+                        tags.add(tag)
+            size = max(1, len(fromTags) // workers)
+            tasks += [(template, fromTags[i:i + size]) for i in xrange(0, len(fromTags), size)]
+        own = pool is None
+        if own:
+            pool = BrillPool(workers)
+        try:
+            pool.update(self.frequencies, self.orderedList, tags)
+            best = Transformation()
+            for curTransform in pool.map(tasks):
+                if curTransform.score > best.score:
+                    best = curTransform
+        finally:
+            if own:
+                pool.close()
+        return best
+
     def open_fromTags(self):
         # print 'function open_fromTags', time.asctime()
         fromTags = []
@@ -399,10 +1110,11 @@ class BrillTrainer:
                 contexts = [(nums, types, w) for w in self.frequencies[4][froms].keys()]
         return contexts
 
-    def get_best_instance(self, template):
+    def get_best_instance(self, template, fromTags=None):
         # print 'function get_best_instance', time.asctime()
         best = Transformation()
-        fromTags = self.open_fromTags()
+        if fromTags is None:
+            fromTags = self.open_fromTags()
         for fromTag in fromTags:  # fromTags = all types of POS-homonymy in our corpus, e.g. N_A_PRON
             toTags = fromTag.split('_')
 
@@ -423,48 +1135,205 @@ class BrillTrainer:
                             best.meta = (fromTag, toTag, bestZ[2])
         return best
 
-    def apply_transformation(self, bestTransform, corpus):
+    def apply_transformation(self, bestTransform):
+        """
+        Applies the transformation to the words tagged with its fromTag, which are found in the index positions.
+        The words are visited from left to right, so a word sees the changes made to the previous words.
+        Returns the list of changed positions.
+        """
         # print 'function apply_transformation', time.asctime()
         nums, types, item = bestTransform.meta[2]
         fromTag = bestTransform.meta[0]
         toTag = bestTransform.meta[1]
-        if types == 'word':
-            types = 0  # word or tag
-        elif types == 'tag':
-            types = 1
-        for se in xrange(len(corpus)):
-            corpus[se] = corpus[se].split()
-            for word in xrange(len(corpus[se])):
-                w = corpus[se][word].split('/')
-                if w[1] == fromTag:
-                    if (nums == -1 and word != 0) or (nums == 1 and word != len(corpus[se]) - 1):
-                        w_other = corpus[se][word + nums].split('/')
-                        if w_other[types] == item:
-                            corpus[se][word] = re.sub(fromTag, toTag, corpus[se][word])
-            corpus[se] = ' '.join(corpus[se])
-        return corpus
-
-    def freq(self, corpus):
+        context = getattr(self, 'context_' + types)
+        key = getattr(self, 'key_' + types)(item)
+        if fromTag not in self.tagIds:
+            return []
+        if len(self.sentOf) != len(self.tags):
+            self.index_positions()
+        if self.instances is not None:
+            changed = self.apply_to_instances(fromTag, toTag, nums, types, key)
+            if changed is not None:
+                self.update_instances(changed)
+                return changed
+        fromId = self.tagIds[fromTag]
+        words, tags, starts = self.words, self.tags, self.sentStarts
+        changed = []
+        for word in sorted(self.positions[fromId]):
+            se = self.sentOf[word]
+            first, last = starts[se], starts[se + 1] - 1
+            if key in context(word, nums, first, last):
+                w, t = self.transform_token(words[word], fromTag, toTag)
+                if (w, t) != (words[word], fromId):
+                    changed.append(word)
+                if t != fromId:
+                    self.positions[fromId].remove(word)
+                    self.positions[t].add(word)
+                words[word], tags[word] = w, t
+        if self.instances is not None:
+            self.update_instances(changed)
+        return changed
+
+    def transform_token(self, wordId, fromTag, toTag):
+        """
+        Changes fromTag to toTag in the word with the given id, as re.sub did on the 'word/TAG' string.
+        Returns the ids (word id, tag id) of the result.
+        """
+        w, t = re.sub(fromTag, toTag, self.wordList[wordId] + '/' + fromTag).rsplit('/', 1)
+        return self.get_id(self.wordIds, self.wordList, w), self.get_id(self.tagIds, self.tagList, t)
+
+    #TEMPLATES
+    # A template (nums, types) is defined by three methods:
+    # context_<types>(i, nums, first, last) returns the context keys of the word at position i
+    # (first and last are the positions of the first and the last word of its sentence),
+    # key_<types>(item) returns the key of a context written in a rule, item_<types>(key) writes a key for a rule.
+    # Tag ids are kept below 2 ** 20, so that a word id and a tag id can be packed into one key.
+
+    def context_tag(self, i, nums, first, last):
+        """
+        The tag of the word at the distance nums.
+        """
+        if first <= i + nums <= last:
+            return [self.tags[i + nums]]
+        return []
+
+    def key_tag(self, item):
+        return self.get_id(self.tagIds, self.tagList, item)
+
+    def item_tag(self, key):
+        return self.tagList[key]
+
+    def context_word(self, i, nums, first, last):
+        """
+        The word at the distance nums.
+        """
+        if first <= i + nums <= last:
+            return [self.words[i + nums]]
+        return []
+
+    def key_word(self, item):
+        return self.get_id(self.wordIds, self.wordList, item)
+
+    def item_word(self, key):
+        return self.wordList[key]
+
+    def context_anytag(self, i, nums, first, last):
+        """
+        The tags of the next (nums=2) or the previous (nums=-2) two words, any of them.
+        """
+        step = 1 if nums > 0 else -1
+        keys = []
+        for j in xrange(i + step, i + nums + step, step):
+            if first <= j <= last and self.tags[j] not in keys:
+                keys.append(self.tags[j])
+        return keys
+
+    key_anytag = key_tag
+    item_anytag = item_tag
+
+    def context_wordtag(self, i, nums, first, last):
+        """
+        The current word together with the tag of the word at the distance nums, written as 'word/TAG'.
+        """
+        if first <= i + nums <= last:
+            return [self.words[i] << 20 | self.tags[i + nums]]
+        return []
+
+    def key_wordtag(self, item):
+        w, t = item.rsplit('/', 1)
+        return self.get_id(self.wordIds, self.wordList, w) << 20 | self.get_id(self.tagIds, self.tagList, t)
+
+    def item_wordtag(self, key):
+        return self.wordList[key >> 20] + '/' + self.tagList[key & 0xFFFFF]
+
+    def freq(self):
+        """
+        Counts the tags and their contexts in the corpus.
+        Returns dictionaries with string keys, the keys are inserted in the order of their first occurrence.
+        As before, the contexts are counted for the last word of each sentence only.
+        If the instances are indexed (see index_instances), they are counted with their weights instead of the words.
+        """
         # print 'function freq', time.asctime()
+        if self.instances is not None:
+            return self.freq_instances()
+        if self.vectorized:
+            return self.freq_numpy()
+        d = defaultdict(int)
+        word_next, word_prev, tag_next, tag_prev = defaultdict(dict), defaultdict(dict), defaultdict(
+            dict), defaultdict(dict)
+        tagList, wordList = self.tagList, self.wordList
+        counts = [0] * len(tagList)
+        order = []
+        for t in self.tags:
+            if counts[t] == 0:
+                order.append(t)
+            counts[t] += 1
+        for t in order:
+            cur_tag = tagList[t]
+            d[cur_tag] = counts[t]
+            word_next[cur_tag], word_prev[cur_tag], tag_next[cur_tag], tag_prev[cur_tag] = defaultdict(
+                int), defaultdict(int), defaultdict(int), defaultdict(int)
+        words, tags, starts = self.words, self.tags, self.sentStarts
+        for se in xrange(len(starts) - 1):
+            last = starts[se + 1] - 1
+            if last > starts[se]:
+                cur_tag = tagList[tags[last]]
+                word_prev[cur_tag][wordList[words[last - 1]]] += 1
+                tag_prev[cur_tag][tagList[tags[last - 1]]] += 1
+        return d, word_next, tag_next, word_prev, tag_prev
+
+    def freq_instances(self):
+        """
+        Counts the same dictionaries as freq from the weighted instances, in the order of their first positions.
+        """
         d = defaultdict(int)
         word_next, word_prev, tag_next, tag_prev = defaultdict(dict), defaultdict(dict), defaultdict(
             dict), defaultdict(dict)
-        for line in corpus:
-            line = line.split()
-            for word in xrange(len(line)):
-                cur_w, cur_tag = line[word].split('/')
-                d[cur_tag] += 1
-                if d[cur_tag] == 1:
-                    word_next[cur_tag], word_prev[cur_tag], tag_next[cur_tag], tag_prev[cur_tag] = defaultdict(
-                        int), defaultdict(int), defaultdict(int), defaultdict(int)
-            if word != len(line) - 1:
-                w_next, t_next = line[word + 1].split('/')
-                word_next[cur_tag][w_next] += 1
-                tag_next[cur_tag][t_next] += 1
-            if word != 0:
-                w_prev, t_prev = line[word - 1].split('/')
-                word_prev[cur_tag][w_prev] += 1
-                tag_prev[cur_tag][t_prev] += 1
+        tagList, wordList = self.tagList, self.wordList
+        instances = sorted(self.instances, key=self.instanceFirst.get)
+        for prevWord, prevTag, tag, nextTag, nextWord in instances:
+            cur_tag = tagList[tag]
+            if cur_tag not in d:
+                word_next[cur_tag], word_prev[cur_tag], tag_next[cur_tag], tag_prev[cur_tag] = defaultdict(
+                    int), defaultdict(int), defaultdict(int), defaultdict(int)
+            d[cur_tag] += len(self.instances[(prevWord, prevTag, tag, nextTag, nextWord)])
+        for instance in instances:
+            prevWord, prevTag, tag, nextTag, nextWord = instance
+            if nextTag == -1 and prevTag != -1:  # the last word of a sentence
+                cur_tag = tagList[tag]
+                word_prev[cur_tag][wordList[prevWord]] += len(self.instances[instance])
+                tag_prev[cur_tag][tagList[prevTag]] += len(self.instances[instance])
+        return d, word_next, tag_next, word_prev, tag_prev
+
+    def freq_numpy(self):
+        """
+        Counts the same tables as freq with NumPy from the arrays of the corpus.
+        The tags are counted with bincount and the contexts with unique over the keys (tag id, context id),
+        the dictionaries of the contexts of a tag are only made when the tag is looked up (see ContextCounts).
+        """
+        d = defaultdict(int)
+        word_next, tag_next = defaultdict(dict), defaultdict(dict)
+        tags = np.frombuffer(self.tags, dtype='i')  # the arrays are read without copying
+        words = np.frombuffer(self.words, dtype='i')
+        starts = np.frombuffer(self.sentStarts, dtype='l')
+        counts = np.bincount(tags, minlength=len(self.tagList))
+        firsts = {}  # the first positions of the tags are looked for in growing blocks from the start
+        block, pos = 4096, 0
+        while len(firsts) < np.count_nonzero(counts):
+            present, found = np.unique(tags[pos:pos + block], return_index=True)
+            for t, i in zip(present.tolist(), found.tolist()):
+                if t not in firsts:
+                    firsts[t] = pos + i
+            pos += block
+            block *= 2
+        for t in sorted(firsts, key=firsts.get):
+            cur_tag = self.tagList[t]
+            d[cur_tag] = int(counts[t])
+            word_next[cur_tag], tag_next[cur_tag] = defaultdict(int), defaultdict(int)
+        lasts = starts[1:] - 1
+        lasts = lasts[lasts > starts[:-1]]
+        word_prev = ContextCounts(tags[lasts], words[lasts - 1], self.tagIds, self.wordList)
+        tag_prev = ContextCounts(tags[lasts], tags[lasts - 1], self.tagIds, self.tagList)
         return d, word_next, tag_next, word_prev, tag_prev
 
     def inContext(self, tag, context):
@@ -506,6 +1375,7 @@ class BrillTrainer:
             rules = self.open_transformations(rules)
         else:
             rules = self.orderedList
+        rules = self.compile_rules(rules)
         print 'Applying learned transformations to directory %s...' % path
         for root, dirs, files in os.walk(path):
             for fname in files:
@@ -552,43 +1422,102 @@ class BrillTrainer:
             gr = gr.split(',')[0]
         return gr
 
+    def compile_rules(self, rules):
+        """
+        Parses the transformations for apply_it.
+        Returns the list of rules (fromTag, toTag, position, types, context, prefix of gr for toTag)
+        and the index {fromTag: [numbers of the rules with this fromTag]}.
+        """
+        compiled = []
+        byFromTag = defaultdict(list)
+        for t in rules:
+            fromTag, toTag, position, types, context = t.split('\t')
+            byFromTag[fromTag].append(len(compiled))
+            compiled.append((fromTag, toTag, int(position), types, context, toTag.replace(':', ',')))
+        return compiled, byFromTag
+
+    def file_contexts(self, tags, forms, w, position, types):
+        """
+        Returns the contexts of the word w of a sentence for a rule of an extended template (see run_brill),
+        as strings, the same as the context_ methods give while learning.
+        tags and forms: the tags and the word forms of the sentence.
+        """
+        words = [(f or u'').strip() for f in forms]
+        if types == 'anytag':
+            step = 1 if position > 0 else -1
+            return [tags[j] for j in xrange(w + step, w + position + step, step) if 0 <= j < len(tags)]
+        if not 0 <= w + position < len(tags):
+            return []
+        if types == 'tag':
+            return [tags[w + position]]
+        if types == 'word':
+            return [words[w + position]]
+        if types == 'wordtag':
+            return [words[w] + '/' + tags[w + position]]
+        return []
+
     def apply_it(self, path, rules):
+        """
+        Applies the transformations compiled by compile_rules to the file path and rewrites the file.
+
+        Each sentence is processed once: the tag of every word is computed once and changed only when a rule fires,
+        and only the rules whose fromTag occurs in the sentence are tried, in the order of the list.
+        A rule is applied to the words from left to right, so it sees the changes it has made to the previous words,
+        the result is the same as applying the rules to the whole file one after another.
+        """
         changes = 0
+        compiled, byFromTag = rules
         root = etree.parse(path).getroot()  # get a text from the corpus
-        for t in rules:
-            fromTag, toTag, position, types, context = t.split('\t')
-            position = int(position)
-            for se in root[1]:
+        for se in root[1]:
+            if not byFromTag:
+                break
+            anas = [[ana for ana in w] for w in se]
+            tags = [self.transform_anas(a) for a in anas]
+            forms = [a[-1].tail for a in anas]  # current word
+            changed = [False] * len(se)
+            queue = []
+            for tag in set(tags):
+                queue += byFromTag.get(tag, [])
+            queue = sorted(set(queue))
+            queued = set(queue)
+            while queue:
+                r = heapq.heappop(queue)
+                fromTag, toTag, position, types, context, prefix = compiled[r]
                 for w in range(len(se)):
-                    new_x = [ana for ana in se[w]]
-                    cur_w = new_x[-1].tail  # current word
-                    for i in xrange(len(se[w])):  # ==for ana in word:
-                        se[w].remove(se[w][0])  # deleted all ana from the tree
-                    if len(new_x) > 1:
-                        a = new_x
-                        tag = self.transform_anas(a)
-                        if tag == fromTag:
-                            try:
-                                if types == 'tag':
-                                    other = self.transform_anas([ana for ana in se[w + position] if w + position != -1])
-                                elif types == 'word':
-                                    other = [ana for ana in se[w + position] if w + position != -1][-1].tail
-                                if other == context:
-                                    new_x2 = [ana for ana in new_x if
-                                              ana.attrib['gr'].startswith(toTag.replace(':', ','))]
-                                    changes += 1
-                                    for x in new_x2:
-                                        x.tail = None
-                                        se[w].append(x)
-                            except IndexError:
-                                pass
-                            except AttributeError:
-                                print [ana for ana in se[w]][-1].tail
-                    if len(se[w]) == 0:
-                        for i in new_x:
-                            se[w].append(i)
-                    else:
-                        se[w][-1].tail = cur_w
+                    if len(anas[w]) > 1 and tags[w] == fromTag:
+                        if position not in (-1, 1) or types not in ('tag', 'word'):
+                            if context not in self.file_contexts(tags, forms, w, position, types):
+                                continue
+                            other = context
+                        elif w + position == -1:
+                            if types != 'tag':
+                                continue
+                            other = u''
+                        elif w + position >= len(se):
+                            continue
+                        elif types == 'tag':
+                            other = tags[w + position]
+                        elif types == 'word':
+                            other = forms[w + position]
+                        if other == context:
+                            new_x2 = [ana for ana in anas[w] if ana.attrib['gr'].startswith(prefix)]
+                            changes += 1
+                            if new_x2:
+                                anas[w] = new_x2
+                                changed[w] = True
+                                tags[w] = self.transform_anas(new_x2)
+                                for n in byFromTag.get(tags[w], []):
+                                    if n > r and n not in queued:
+                                        heapq.heappush(queue, n)
+                                        queued.add(n)
+            for w in range(len(se)):
+                if changed[w]:
+                    for ana in [ana for ana in se[w]]:
+                        se[w].remove(ana)
+                    for x in anas[w]:
+                        x.tail = None
+                        se[w].append(x)
+                    se[w][-1].tail = forms[w]
 
         out = etree.tostring(root, pretty_print=True, encoding=unicode)
         fOut = codecs.open(path, 'w', 'utf-8-sig')
@@ -598,19 +1527,563 @@ class BrillTrainer:
         print "%s changes in file, %s changes in total" % (changes, self.changes)
 
 
+class ContextCounts(dict):
+    """
+    Counts of the contexts of each tag made by BrillTrainer.freq_numpy.
+
+    counts[tag] is a dictionary {context: count} as freq makes it, with the contexts inserted
+    in the order of their first occurrence, so it is iterated in the same order.
+    The dictionary of a tag is made from the counted arrays when the tag is first looked up.
+    """
+
+    def __init__(self, tags, items, tagIds, itemList):
+        """
+        tags, items: arrays of the tag id and the context id of each counted word, in the order of the corpus.
+        """
+        dict.__init__(self)
+        width = len(itemList) + 1
+        keys, firsts, counts = np.unique(tags.astype(np.int64) * width + items, return_index=True, return_counts=True)
+        order = np.lexsort((firsts, keys // width))
+        self.tags = (keys // width)[order]
+        self.items = (keys % width)[order]
+        self.counts = counts[order]
+        self.tagIds = tagIds
+        self.itemList = itemList
+
+    def __missing__(self, tag):
+        t = self.tagIds.get(tag)
+        if t is None:
+            table = {}
+        else:
+            table = defaultdict(int)
+            lo, hi = np.searchsorted(self.tags, [t, t + 1]).tolist()
+            for item, n in zip(self.items[lo:hi].tolist(), self.counts[lo:hi].tolist()):
+                table[self.itemList[item]] = n
+        self[tag] = table
+        return table
+
+
+class TemplateCounts:
+    """
+    Context counts for BrillTrainer.run_brill with a list of templates.
+
+    For every template there is a keyed counter {tag id: {context key: number of words}},
+    the keys are given by the context_ methods of the trainer, so a new kind of template only needs new methods.
+    The counters are filled once, and after a transformation is applied only the words around the changed positions
+    are counted again, so an iteration costs time proportional to the number of templates and the changes.
+    Unlike freq, the contexts are counted for every word of the sentence.
+    The candidates are tried in the order of the templates, the fromTags and the context keys.
+    """
+
+    def __init__(self, trainer, templates):
+        self.trainer = trainer
+        trainer.index_positions()
+        self.templates = templates
+        self.contexts = [getattr(trainer, 'context_' + types) for nums, types in templates]
+        self.counters = [defaultdict(dict) for template in templates]
+        self.width = max([abs(nums) for nums, types in templates] + [0])
+        self.groups = {}  # (template number, fromTag): best candidate rule
+        for i in xrange(len(trainer.tags)):
+            for k, t, key in self.word_contexts(i):
+                counter = self.counters[k][t]
+                counter[key] = counter.get(key, 0) + 1
+
+    def word_contexts(self, i):
+        """
+        Returns the list of (template number, tag id, context key) for the word at position i.
+        """
+        starts = self.trainer.sentStarts
+        s = self.trainer.sentOf[i]
+        first, last = starts[s], starts[s + 1] - 1
+        t = self.trainer.tags[i]
+        return [(k, t, key) for k in xrange(len(self.templates))
+                for key in self.contexts[k](i, self.templates[k][0], first, last)]
+
+    def tag_count(self, tag):
+        return len(self.trainer.positions.get(self.trainer.tagIds.get(tag), ()))
+
+    def counter(self, k, tag):
+        """
+        Returns {context key: number of words} of the tag for the template number k.
+        """
+        return self.counters[k].get(self.trainer.tagIds.get(tag), {})
+
+    def get_best_group(self, k, fromTag, excluded):
+        """
+        Returns the best transformation of fromTag for the template number k, or None.
+        The score is counted as in get_best_instance.
+        """
+        if (k, fromTag) not in self.groups:
+            best = None
+            nums, types = self.templates[k]
+            item = getattr(self.trainer, 'item_' + types)
+            toTags = fromTag.split('_')
+            counts = dict((tag, self.tag_count(tag)) for tag in toTags)
+            counters = dict((tag, self.counter(k, tag)) for tag in toTags)
+
+            def estimate(toTag, tag, key):
+                if counts[tag] == 0:
+                    return 0
+                return float(counts[toTag]) / counts[tag] * counters[tag].get(key, 0)
+
+            contexts = sorted(self.counter(k, fromTag))
+            for toTag in toTags:
+                arrZ = [tag for tag in toTags if tag != toTag]
+                for key in contexts:
+                    bestZ = max(arrZ, key=lambda tag: estimate(toTag, tag, key))
+                    new_score = counters[toTag].get(key, 0) - estimate(toTag, bestZ, key)
+                    if new_score > (best.score if best else 0):
+                        new_rule = fromTag + u"\t" + toTag + u"\t" + str(nums) + u'\t' + types + u'\t' + item(key)
+                        if new_rule not in excluded:
+                            best = Transformation()
+                            best.rule = new_rule
+                            best.score = new_score
+                            best.meta = (fromTag, toTag, (nums, types, item(key)))
+            self.groups[(k, fromTag)] = best
+        return self.groups[(k, fromTag)]
+
+    def get_best_transform(self, templates, excluded):
+        """
+        Returns the best transformation for the current state of the corpus.
+        templates: not used, the templates are given to the constructor.
+        excluded: the rules that are already learned.
+        """
+        positions, tagList = self.trainer.positions, self.trainer.tagList
+        fromTags = sorted(tagList[t] for t in positions if positions[t] and '_' in tagList[t])
+        best = Transformation()
+        for k in xrange(len(self.templates)):
+            for fromTag in fromTags:
+                curTransform = self.get_best_group(k, fromTag, excluded)
+                if curTransform is not None and curTransform.score > best.score:
+                    best = curTransform
+        return best
+
+    def apply_transformation(self, bestTransform):
+        """
+        Applies the transformation with BrillTrainer.apply_transformation and counts again the contexts
+        of the words around the changed positions. Returns the number of changes.
+        Only the groups of the tags whose counts have changed are scored again.
+        """
+        trainer = self.trainer
+        words, tags, starts, tagList = trainer.words, trainer.tags, trainer.sentStarts, trainer.tagList
+        fromTag = bestTransform.meta[0]
+        f = trainer.tagIds.get(fromTag)
+        oldWords = dict((i, words[i]) for i in trainer.positions.get(f, ()))
+        changed = trainer.apply_transformation(bestTransform)
+        newValues = [(i, words[i], tags[i]) for i in changed]
+        affected = set()
+        for i in changed:
+            s = trainer.sentOf[i]
+            affected.update(xrange(max(starts[s], i - self.width), min(starts[s + 1] - 1, i + self.width) + 1))
+        delta = defaultdict(int)
+        for i in changed:  # the old contexts are taken with the old values
+            words[i], tags[i] = oldWords[i], f
+        for j in affected:
+            for context in self.word_contexts(j):
+                delta[context] -= 1
+        for i, w, t in newValues:
+            words[i], tags[i] = w, t
+        for j in affected:
+            for context in self.word_contexts(j):
+                delta[context] += 1
+        dirty = set()  # (template number, tag) with changed counters
+        for (k, t, key), n in delta.iteritems():
+            if n:
+                counter = self.counters[k][t]
+                c = counter.get(key, 0) + n
+                if c:
+                    counter[key] = c
+                else:
+                    del counter[key]
+                dirty.add((k, tagList[t]))
+        retagged = set([fromTag] + [tagList[t] for i, w, t in newValues])  # tags with changed frequencies
+        for k, tag in self.groups.keys():
+            parts = [tag] + tag.split('_')
+            if retagged.intersection(parts) or [part for part in parts if (k, part) in dirty]:
+                del self.groups[(k, tag)]
+        return len(changed)
+
+
+class SampledCounts(TemplateCounts):
+    """
+    Lazy transformation-based learning for BrillTrainer.run_brill with a sample.
+
+    On every iteration the contexts of a random sample of words are counted and the groups of candidates
+    (template, fromTag) are ranked by the best score they get on the sample, with the formula of get_best_instance.
+    Only the best groups are scored on the whole corpus, as in TemplateCounts.
+    The exact counts of a tag are collected from its positions only when a group needs them,
+    and they are kept until a transformation changes the words around that tag.
+    """
+
+    def __init__(self, trainer, templates, size, seed=0, check=5):
+        """
+        size: number of words in the sample.
+        check: number of the best groups of the sample that are scored on the whole corpus.
+        """
+        self.trainer = trainer
+        trainer.index_positions()
+        self.templates = templates
+        self.contexts = [getattr(trainer, 'context_' + types) for nums, types in templates]
+        self.width = max([abs(nums) for nums, types in templates] + [0])
+        self.groups = {}
+        self.size = size
+        self.check = check
+        self.random = random.Random(seed)
+        self.exact = {}  # (template number, tag): {context key: number of words with the tag}
+
+    def counter(self, k, tag):
+        if (k, tag) not in self.exact:
+            trainer = self.trainer
+            starts = trainer.sentStarts
+            counter = defaultdict(int)
+            for i in trainer.positions.get(trainer.tagIds.get(tag), ()):
+                s = trainer.sentOf[i]
+                for key in self.contexts[k](i, self.templates[k][0], starts[s], starts[s + 1] - 1):
+                    counter[key] += 1
+            self.exact[(k, tag)] = counter
+        return self.exact[(k, tag)]
+
+    def sample_groups(self, excluded):
+        """
+        Counts the contexts of a new sample and returns the groups (template number, fromTag)
+        that have a candidate with a positive score on the sample, the best first.
+        A group is ranked by its best candidate that is not among the excluded rules.
+        """
+        trainer = self.trainer
+        tagList = trainer.tagList
+        sample = self.random.sample(xrange(len(trainer.tags)), min(self.size, len(trainer.tags)))
+        tagCounts = defaultdict(int)
+        counters = [defaultdict(lambda: defaultdict(int)) for template in self.templates]
+        for i in sorted(sample):
+            tagCounts[tagList[trainer.tags[i]]] += 1
+            for k, t, key in self.word_contexts(i):
+                counters[k][tagList[t]][key] += 1
+        groups = []
+        for k in xrange(len(self.templates)):
+            nums, types = self.templates[k]
+            item = getattr(trainer, 'item_' + types)
+            for fromTag in sorted(tag for tag in counters[k] if '_' in tag):
+                toTags = fromTag.split('_')
+                best = 0
+                for toTag in toTags:
+                    for key in counters[k][fromTag]:
+                        estimates = [tagCounts[toTag] / tagCounts[tag] * counters[k][tag][key] if tagCounts[tag] else 0
+                                     for tag in toTags if tag != toTag]
+                        score = counters[k][toTag][key] - max(estimates)
+                        if score > best and (fromTag + u"\t" + toTag + u"\t" + str(nums) + u'\t' + types + u'\t' +
+                                             item(key)) not in excluded:
+                            best = score
+                if best > 0:
+                    groups.append((-best, k, fromTag))
+        return [(k, fromTag) for score, k, fromTag in sorted(groups)]
+
+    def get_best_transform(self, templates, excluded):
+        """
+        Returns the best transformation of the best groups of a new sample.
+        templates: not used, the templates are given to the constructor.
+        excluded: the rules that are already learned.
+        """
+        best = Transformation()
+        # the groups are scored in the order of TemplateCounts.get_best_transform, so the ties are broken in the same way
+        for k, fromTag in sorted(self.sample_groups(excluded)[:self.check]):
+            curTransform = self.get_best_group(k, fromTag, excluded)
+            if curTransform is not None and curTransform.score > best.score:
+                best = curTransform
+        return best
+
+    def apply_transformation(self, bestTransform):
+        """
+        Applies the transformation with BrillTrainer.apply_transformation
+        and forgets the exact counts and the groups of the tags around the changed positions.
+        Returns the number of changes.
+        """
+        trainer = self.trainer
+        starts, tagList = trainer.sentStarts, trainer.tagList
+        changed = trainer.apply_transformation(bestTransform)
+        dirty = set([bestTransform.meta[0]])
+        for i in changed:
+            s = trainer.sentOf[i]
+            for j in xrange(max(starts[s], i - self.width), min(starts[s + 1] - 1, i + self.width) + 1):
+                dirty.add(tagList[trainer.tags[j]])
+        for k, tag in self.exact.keys():
+            if tag in dirty:
+                del self.exact[(k, tag)]
+        for k, tag in self.groups.keys():
+            if dirty.intersection([tag] + tag.split('_')):
+                del self.groups[(k, tag)]
+        return len(changed)
+
+
+class BrillPool:
+    """
+    Worker processes for BrillTrainer.get_best_transform_parallel, started once for the whole run_brill.
+
+    Every worker keeps its own copy of the frequency tables and of the learned rules.
+    On every iteration update puts into the queue of each worker only the context tables that changed
+    since the previous iteration, the tag counts and the new rules. The tables are sent as lists of items,
+    because a pickled dictionary may iterate in another order, and the order of the contexts breaks the ties
+    (see WorkerTable). The tasks of the iteration are then
+    shared by all workers through one queue and carry the number of the iteration,
+    so a worker reads the updates it has not applied yet before it scores a task (see brill_worker).
+    """
+
+    def __init__(self, workers):
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.updates = [multiprocessing.Queue() for i in xrange(workers)]
+        self.processes = [multiprocessing.Process(target=brill_worker, args=(updates, self.tasks, self.results))
+                          for updates in self.updates]
+        for process in self.processes:
+            process.daemon = True
+            process.start()
+        self.iteration = 0
+        self.sent = {}  # (k, tag): items of the table the workers have
+        self.rules = 0  # number of rules the workers have
+
+    def update(self, frequencies, orderedList, tags):
+        """
+        Sends to every worker the tables of the given tags that differ from the ones it has.
+        The tables are compared with their items, so a table with the same counts in another order is sent as well.
+        """
+        self.iteration += 1
+        changed = {}
+        for k in xrange(1, 5):
+            for tag in tags:
+                items = frequencies[k][tag].items()
+                if self.sent.get((k, tag)) != items:
+                    changed[(k, tag)] = items
+                    self.sent[(k, tag)] = items
+        message = (self.iteration, frequencies[0], changed, orderedList[self.rules:])
+        self.rules = len(orderedList)
+        for updates in self.updates:
+            updates.put(message)
+
+    def map(self, tasks):
+        """
+        Returns the results of get_best_instance for the tasks (template, fromTags) in the order of the tasks.
+        """
+        for i, task in enumerate(tasks):
+            self.tasks.put((self.iteration, i, task))
+        results = [None] * len(tasks)
+        for n in xrange(len(tasks)):
+            i, result = self.results.get()
+            if isinstance(result, Exception):
+                raise result
+            results[i] = result
+        return results
+
+    def close(self):
+        for process in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+
+class WorkerTable(dict):
+    """
+    A context table in a worker of BrillPool, keys returns the contexts in the order of the table of the trainer.
+    """
+
+    def __init__(self, items):
+        dict.__init__(self, items)
+        self.order = [item for item, count in items]
+
+    def keys(self):
+        return self.order
+
+
+def brill_worker(updates, tasks, results):
+    """
+    Runs in every worker process of BrillPool, scores the tasks with the tables sent through updates.
+    """
+    trainer = BrillTrainer()
+    trainer.orderedList = []
+    frequencies = [defaultdict(int)] + [defaultdict(dict) for k in xrange(4)]
+    version = 0
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        iteration, i, (template, fromTags) = task
+        while version < iteration:
+            version, frequencies[0], changed, rules = updates.get()
+            for (k, tag), items in changed.iteritems():
+                frequencies[k][tag] = WorkerTable(items)
+            trainer.orderedList.extend(rules)
+        trainer.frequencies = tuple(frequencies)
+        try:
+            results.put((i, trainer.get_best_instance(template, fromTags)))
+        except Exception as e:
+            results.put((i, e))
+
+
+class BrillIndex:
+    """
+    Incremental counts for BrillTrainer.run_brill(incremental=True).
+
+    Works on the arrays of the trainer (words, tags, sentStarts) and its index of positions,
+    and keeps the counts that freq would return.
+    After a transformation is applied, only the positions that changed and the sentences they belong to are recounted,
+    and only the candidate rules whose tags are affected are scored again.
+
+    The learned rules are the same as those of the full recount:
+    the dictionaries are rebuilt in the order freq would fill them, so the ties are broken in the same way,
+    and the context counts are taken for the last word of each sentence only, as freq takes them.
+    """
+
+    def __init__(self, trainer):
+        self.trainer = trainer
+        trainer.index_positions()
+        tags, starts = trainer.tags, trainer.sentStarts
+        self.firstPos = {}  # tag id: first position of the tag in the corpus
+        self.lastSents = defaultdict(set)  # tag id: sentences (of 2 words and more) ending with the tag
+        for t in trainer.positions:
+            self.firstPos[t] = min(trainer.positions[t])
+        for s in xrange(len(starts) - 1):
+            if starts[s + 1] - starts[s] > 1:
+                self.lastSents[tags[starts[s + 1] - 1]].add(s)
+        self.contexts = {}  # tag id: (tag_prev, word_prev) as freq counts them
+        self.groups = {}  # (types, fromTag): best candidate rule
+
+    def frequencies(self):
+        """
+        Returns the dictionary of tag frequencies with the keys inserted in the same order as freq inserts them.
+        """
+        d = {}
+        for t in sorted(self.firstPos, key=self.firstPos.get):
+            d[self.trainer.tagList[t]] = len(self.trainer.positions[t])
+        return d
+
+    def count(self, tag):
+        return len(self.trainer.positions.get(self.trainer.tagIds.get(tag), ()))
+
+    def context(self, tag, types):
+        """
+        Returns the dictionary {previous tag or word: frequency} for the sentences ending with tag.
+        """
+        t = self.trainer.tagIds.get(tag)
+        if t is None:
+            return {}
+        if t not in self.contexts:
+            words, tags, starts = self.trainer.words, self.trainer.tags, self.trainer.sentStarts
+            tagList, wordList = self.trainer.tagList, self.trainer.wordList
+            tagPrev, wordPrev = {}, {}
+            for s in sorted(self.lastSents[t]):
+                i = starts[s + 1] - 2
+                tagPrev[tagList[tags[i]]] = tagPrev.get(tagList[tags[i]], 0) + 1
+                wordPrev[wordList[words[i]]] = wordPrev.get(wordList[words[i]], 0) + 1
+            self.contexts[t] = (tagPrev, wordPrev)
+        if types == 'tag':
+            return self.contexts[t][0]
+        return self.contexts[t][1]
+
+    def estimate(self, toTag, tag, item, types):
+        fY, fZ = self.count(toTag), self.count(tag)
+        contextZC = self.context(tag, types).get(item, 0)
+        if fZ == 0:
+            return 0
+        else:
+            return float(fY) / fZ * contextZC
+
+    def get_best_group(self, fromTag, types, excluded):
+        """
+        Returns the best transformation of fromTag with a context of the previous word (types='word') or tag,
+        scored as get_best_instance scores it, or None.
+        """
+        key = (types, fromTag)
+        if key not in self.groups:
+            best = None
+            contexts = self.context(fromTag, types)
+            toTags = fromTag.split('_')
+            for toTag in toTags:
+                for item in contexts:
+                    arrZ = [tag for tag in toTags if tag != toTag]
+                    bestZ = max(arrZ, key=lambda tag: self.estimate(toTag, tag, item, types))
+                    new_score = self.context(toTag, types).get(item, 0) - self.estimate(toTag, bestZ, item, types)
+                    if new_score > (best.score if best else 0):
+                        new_rule = fromTag + u"\t" + toTag + u"\t" + str(-1) + u'\t' + types + u'\t' + item
+                        if new_rule not in excluded:
+                            best = Transformation()
+                            best.rule = new_rule
+                            best.score = new_score
+                            best.meta = (fromTag, toTag, (-1, types, item))
+            self.groups[key] = best
+        return self.groups[key]
+
+    def get_best_transform(self, templates, excluded):
+        """
+        Returns the best transformation for the current state of the corpus, the same as BrillTrainer.get_best_transform.
+        excluded: the rules that are already learned.
+        """
+        d = self.frequencies()
+        best = Transformation()
+        for nums, types in templates:
+            fromTags = [k for k in d.keys() if '_' in k]
+            for fromTag in fromTags:
+                if nums != -1 or not self.context(fromTag, types):
+                    continue  # freq never counts the next word, so these templates have no contexts
+                for tag in fromTag.split('_'):
+                    if tag not in d:
+                        d[tag] = 0  # estimate adds the missing tags to the frequencies
+                curTransform = self.get_best_group(fromTag, types, excluded)
+                if curTransform is not None and curTransform.score > best.score:
+                    best = curTransform
+        return best
+
+    def apply_transformation(self, bestTransform):
+        """
+        Applies the transformation with BrillTrainer.apply_transformation and updates the counts of the changed positions.
+        Forgets the contexts and the candidate rules that depend on the changed tags.
+        Returns the number of changes.
+        """
+        trainer = self.trainer
+        tags, starts, positions = trainer.tags, trainer.sentStarts, trainer.positions
+        f = trainer.tagIds.get(bestTransform.meta[0])
+        changed = trainer.apply_transformation(bestTransform)
+        dirty = set([f])
+        for i in changed:
+            s = trainer.sentOf[i]
+            start, end = starts[s], starts[s + 1]
+            t = tags[i]
+            if end - start > 1 and i == end - 2:
+                dirty.add(tags[end - 1])
+            if t != f:
+                if end - start > 1 and i == end - 1:
+                    self.lastSents[f].remove(s)
+                    self.lastSents[t].add(s)
+                if t not in self.firstPos or i < self.firstPos[t]:
+                    self.firstPos[t] = i
+                dirty.add(t)
+        if changed:
+            if positions[f]:
+                self.firstPos[f] = min(positions[f])
+            else:
+                del self.firstPos[f]
+        dirtyTags = set([bestTransform.meta[0]])
+        for t in dirty:
+            self.contexts.pop(t, None)
+            if t is not None:
+                dirtyTags.add(trainer.tagList[t])
+        for key in self.groups.keys():
+            if key[1] in dirtyTags or dirtyTags.intersection(key[1].split('_')):
+                del self.groups[key]
+        return len(changed)
+
+
 #************************************#
 # Disambiguation - Viterbi           #
 #************************************#
 
 class HMM:
 
-    def __init__(self, path, extension='.xhtml', printing=False, ambig=True):
+    def __init__(self, path, extension='.xhtml', printing=False, ambig=True, workers=1):
 
         """
         Creates a Hidden Markov Model.
         Starts the search.
 
-        path: unicode string containing the path to the directory where the corpus files are stored
+        path: unicode string containing the path to the directory where the corpus files are stored,
+              or to a cache made by corpus.compile_corpus
         extension: unicode string containing the ending of the filename, e.g. '.xhtml' or 'cheese.txt',
                    this helps to identify files that need to be searched
         printing: True or False,
@@ -619,6 +2092,9 @@ class HMM:
         ambig: True or False,
                True by default, searches only non ambiguous unigrams and bigrams
                if the value is False, assumes that the corpus is manually disambiguated and each word has correct tag
+        workers: number of processes that collect the statistics, 1 by default,
+                 if it is greater than 1, the files are spread over a multiprocessing pool (see collect_parallel)
+        If path is None, creates an empty model without probabilities, the workers collect their counts into it.
         """
         self.states = defaultdict(int)
         self.observations = defaultdict(int)
@@ -626,27 +2102,36 @@ class HMM:
         self.transitionProbabilities = defaultdict(dict)
         self.startProbabilities = defaultdict(int)
         self.starts = 0
+        self.ambig = ambig
+        self.lastTags = (None, None)
+        if path is None:
+            return
 
         print 'Collecting statistics...'
-        if ambig:
+        if workers > 1:
+            self.collect_parallel(path, extension, ambig, workers)
+        elif ambig:
             count = 0
-            for root, dirs, files in os.walk(path):
-                for fName in files:
-                    if fName.endswith(extension):
-                        count += 1
-                        self.search_file_ambig(os.path.join(root, fName))
-                        if count % 300 == 0:
-                            print "Processed %s files." % count
+            for fName, sents in iter_corpus(path, extension):
+                count += 1
+                self.search_file_ambig(fName, sents)
+                if count % 300 == 0:
+                    print "Processed %s files." % count
         elif ambig is False:
             count = 0
-            for root, dirs, files in os.walk(path):
-                for fName in files:
-                    if fName.endswith(extension):
-                        count += 1
-                        self.search_file_not_ambig(os.path.join(root, fName))
-                        if count % 100 == 0:
-                            print "Processed %s files." % count
+            for fName, sents in iter_corpus(path, extension):
+                count += 1
+                self.search_file_not_ambig(fName, sents)
+                if count % 100 == 0:
+                    print "Processed %s files." % count
         # print 'Good bigrams collected. Total: %s bigrams.\r\n' % (len(self.goodBigrs))
+        self.finish(printing)
+
+    def finish(self, printing=False):
+        """
+        Turns the collected counts into probabilities.
+        Is called by __init__ after the search, or after the corpus scan when the model is filled sentence by sentence.
+        """
         print 'Collected %s tags' % len(self.states)
         print 'Collected %s words' % len(self.observations)
         print 'Collecting emission and transition probabilities...'
@@ -656,115 +2141,184 @@ class HMM:
         if printing:
             self.printing()
 
-    def search_file_ambig(self, fName):
+    def start_file(self, fName):
         """
-        Performs the search of good bigrams in a given file fName.
-        Writes the result to the array goodBigrs.
+        Starts a new file when the model is filled sentence by sentence (see collect_sentence).
         """
-        # try:
-        root = etree.parse(fName).getroot()
-        for se in root[1]:
-            for w in range(len(se) - 1):
+        self.lastTags = (None, None)
 
-                curWord = [ana for ana in se[w] if "lex" in ana.attrib]
-                curWord1 = [ana for ana in se[w]]
-                curW = curWord1[-1].tail
-                self.observations[curW] += 1
-                curResult = False
-                if curWord != []:
-                    curPoS = set([x.attrib["gr"].split(u',')[0] for x in curWord])
-                    if (curPoS == {"V", "ADV"} or curPoS == {"PREP", "PRON"} or curPoS == {"V", "PRON"}) and len(
-                            curWord) == 2:  # treating special cases right
-                        curResult = True
+    def collect_sentence(self, se):
+        """
+        Collects the counts from one sentence se, as search_file_ambig or search_file_not_ambig does.
+        """
+        if self.ambig:
+            self.search_sent_ambig(se)
+        else:
+            self.search_sent_not_ambig(se)
 
-                    if len(curWord) == 1 or curResult:
+    def end_file(self, fName):
+        pass
 
-                        try:
-                            curT = curWord[-1].attrib["gr"]
-                            if curT != '':
-                                self.states[curT] += 1
-                                try:
-                                    self.emissionProbabilities[curT][curW] += 1
-                                except KeyError:
-                                    self.emissionProbabilities[curT][curW] = 1
-                        except KeyError:
-                            pass
+    def collect_parallel(self, path, extension, ambig, workers):
+        """
+        Spreads the files over a pool of worker processes.
+        Each worker returns the counts for its files (see hmm_count_files), and the counts are summed,
+        so the result is the same as that of the serial search.
+        """
+        fNames = corpus_files(path, extension)
+        size = max(1, len(fNames) // (workers * 4))
+        tasks = [(path, extension, fNames[i:i + size], ambig) for i in xrange(0, len(fNames), size)]
+        pool = multiprocessing.Pool(workers)
+        count = 0
+        for shard in pool.imap_unordered(hmm_count_files, tasks):
+            self.merge_counts(shard)
+            count += shard[0]
+            print "Processed %s files." % count
+        pool.close()
+        pool.join()
+
+    def counts(self):
+        """
+        Returns the collected counts as plain dictionaries:
+        (tags, words, {tag: {word: count}}, {tag: {next tag: count}}).
+        """
+        return (dict(self.states), dict(self.observations),
+                dict(self.emissionProbabilities), dict(self.transitionProbabilities))
 
-                nextWord = [ana for ana in se[w + 1] if
-                            "lex" in ana.attrib]  # not counting empty tags
-                nextWord1 = [ana for ana in se[w + 1]]
-                nextW = nextWord1[-1].tail
-                if w == len(se) - 1:
-                    self.observations[nextW] += 1
-                nextResult = False
-                if nextWord != []:
-                    nextPoS = set([x.attrib["gr"].split(u',')[0] for x in nextWord])
-                    if (nextPoS == {"V", "ADV"} or nextPoS == {"PREP", "PRON"} or nextPoS == {"V", "PRON"}) and len(
-                            nextWord) == 2:
-                        nextResult = True
-                    if len(nextWord) == 1 or nextResult:
-                        nextT = nextWord[-1].attrib["gr"]
-
-                        if w == len(se) - 1:
-                            if nextT != '':
-                                self.states[nextT] += 1
+    def merge_counts(self, shard):
+        """
+        Adds the counts returned by hmm_count_files to the counts of the model.
+        """
+        states, observations, emission, transition = shard[1]
+        for k, v in states.iteritems():
+            self.states[k] += v
+        for k, v in observations.iteritems():
+            self.observations[k] += v
+        for table, counts in ((self.emissionProbabilities, emission), (self.transitionProbabilities, transition)):
+            for k, row in counts.iteritems():
+                target = table[k]
+                for x, v in row.iteritems():
+                    target[x] = target.get(x, 0) + v
+
+    def search_file_ambig(self, fName, sents=None):
+        """
+        Collects the counts from a given file fName sentence by sentence (see search_sent_ambig).
+        sents: the sentences of the file if they are already read (see iter_corpus), otherwise the file is parsed.
+        """
+        self.lastTags = (None, None)
+        if sents is None:
+            sents = iter_sentences(fName)
+        for se in sents:
+            self.search_sent_ambig(se)
 
-                try:
-                    if (len(nextWord) == 1 or nextResult) and nextT != '' and curT != '':
-                        if len(curWord) == 1 or curResult:
-                            try:
-                                self.transitionProbabilities[curT][nextT] += 1
-                            except KeyError:
-                                self.transitionProbabilities[curT][nextT] = 1
-                except UnboundLocalError:
-                    pass
+    def search_sent_ambig(self, se):
+        """
+        Collects the counts from one sentence se, a list of (wordform, [attributes of ana, ...]).
+        Only non ambiguous words and bigrams are counted.
+        The last tags seen are kept in lastTags and carried over to the next sentence of the file.
+        """
+        curT, nextT = self.lastTags
+        for w in range(len(se) - 1):
 
-        # except:
-        #     print "Class - HMM; function - search_file_ambig(filename); fail at %s" % fName
+            curWord = [ana for ana in se[w][1] if "lex" in ana]
+            curW = se[w][0]
+            self.observations[curW] += 1
+            curResult = False
+            if curWord != []:
+                curPoS = set([x["gr"].split(u',')[0] for x in curWord])
+                if (curPoS == {"V", "ADV"} or curPoS == {"PREP", "PRON"} or curPoS == {"V", "PRON"}) and len(
+                        curWord) == 2:  # treating special cases right
+                    curResult = True
+
+                if len(curWord) == 1 or curResult:
 
-    def search_file_not_ambig(self, fName):
-        """
-                Performs the search of good bigrams in a given file fName.
-                Writes the result to the array goodBigrs.
-                """
-        # try:
-        root = etree.parse(fName).getroot()
-        for se in root[1]:
-            for w in range(len(se) - 1):
-                curWord = [ana for ana in se[w] if "lex" in ana.attrib]
-                if curWord != []:
-                    curW = curWord[-1].tail
-                    self.observations[curW] += 1
                     try:
-                        curT = curWord[-1].attrib["gr"]
+                        curT = curWord[-1]["gr"]
                         if curT != '':
                             self.states[curT] += 1
                             try:
                                 self.emissionProbabilities[curT][curW] += 1
                             except KeyError:
                                 self.emissionProbabilities[curT][curW] = 1
-                    except:
+                    except KeyError:
                         pass
 
-                nextWord = [ana for ana in se[w + 1] if
-                            "lex" in ana.attrib]  # not counting empty tags
-                if nextWord != []:
-                    nextW = nextWord[-1].tail
-                    nextT = nextWord[-1].attrib["gr"]
+            nextWord = [ana for ana in se[w + 1][1] if
+                        "lex" in ana]  # not counting empty tags
+            nextW = se[w + 1][0]
+            if w == len(se) - 1:
+                self.observations[nextW] += 1
+            nextResult = False
+            if nextWord != []:
+                nextPoS = set([x["gr"].split(u',')[0] for x in nextWord])
+                if (nextPoS == {"V", "ADV"} or nextPoS == {"PREP", "PRON"} or nextPoS == {"V", "PRON"}) and len(
+                        nextWord) == 2:
+                    nextResult = True
+                if len(nextWord) == 1 or nextResult:
+                    nextT = nextWord[-1]["gr"]
+
                     if w == len(se) - 1:
-                        self.observations[nextW] += 1
                         if nextT != '':
                             self.states[nextT] += 1
 
-                if nextWord != [] and curWord != [] and nextT != '' and curT != '':
-
+            if (len(nextWord) == 1 or nextResult) and None not in (curT, nextT) and nextT != '' and curT != '':
+                if len(curWord) == 1 or curResult:
                     try:
                         self.transitionProbabilities[curT][nextT] += 1
                     except KeyError:
                         self.transitionProbabilities[curT][nextT] = 1
+        self.lastTags = (curT, nextT)
+
+    def search_file_not_ambig(self, fName, sents=None):
+        """
+        Collects the counts from a given file fName sentence by sentence (see search_sent_not_ambig).
+        sents: the sentences of the file if they are already read (see iter_corpus), otherwise the file is parsed.
+        """
+        self.lastTags = (None, None)
+        if sents is None:
+            sents = iter_sentences(fName)
+        for se in sents:
+            self.search_sent_not_ambig(se)
+
+    def search_sent_not_ambig(self, se):
+        """
+        Collects the counts from one sentence se of a manually disambiguated corpus.
+        The last tags seen are kept in lastTags and carried over to the next sentence of the file.
+        """
+        curT, nextT = self.lastTags
+        for w in range(len(se) - 1):
+            curWord = [ana for ana in se[w][1] if "lex" in ana]
+            if curWord != []:
+                curW = se[w][0]
+                self.observations[curW] += 1
+                try:
+                    curT = curWord[-1]["gr"]
+                    if curT != '':
+                        self.states[curT] += 1
+                        try:
+                            self.emissionProbabilities[curT][curW] += 1
+                        except KeyError:
+                            self.emissionProbabilities[curT][curW] = 1
+                except:
+                    pass
+
+            nextWord = [ana for ana in se[w + 1][1] if
+                        "lex" in ana]  # not counting empty tags
+            if nextWord != []:
+                nextW = se[w + 1][0]
+                nextT = nextWord[-1]["gr"]
+                if w == len(se) - 1:
+                    self.observations[nextW] += 1
+                    if nextT != '':
+                        self.states[nextT] += 1
 
-                            # except:
-                            #     print "Class - HMM; function - search_file_ambig(filename); fail at %s" % fName
+            if nextWord != [] and curWord != [] and None not in (curT, nextT) and nextT != '' and curT != '':
+
+                try:
+                    self.transitionProbabilities[curT][nextT] += 1
+                except KeyError:
+                    self.transitionProbabilities[curT][nextT] = 1
+        self.lastTags = (curT, nextT)
 
     def collect_emission(self):
         '''
@@ -835,29 +2389,312 @@ class HMM:
                 f.write('    ' + str(self.transitionProbabilities[k][w]) + '    ' + w + '\r\n')
         f.close()
 
+    def freeze(self):
+        """
+        Returns a read-only FrozenHMM with the same probabilities.
+        """
+        return FrozenHMM(self)
+
+    def save(self, path):
+        """
+        Writes the model to the directory path (see FrozenHMM.save).
+        """
+        self.freeze().save(path)
+
+    @staticmethod
+    def load(path):
+        """
+        Reads a model written by HMM.save and returns it as a FrozenHMM, no retraining needed.
+        """
+        return FrozenHMM.load(path)
+
+
+
+def hmm_count_files(args):
+    """
+    Runs in a worker process of HMM.collect_parallel.
+    Collects the counts of a list of files into an empty HMM and returns (number of files, counts).
+    """
+    path, extension, fNames, ambig = args
+    shard = HMM(None)
+    for fName, sents in iter_corpus(path, extension, fNames):
+        if ambig:
+            shard.search_file_ambig(fName, sents)
+        elif ambig is False:
+            shard.search_file_not_ambig(fName, sents)
+    return len(fNames), shard.counts()
+
+
+class FrozenTable:
+    """
+    Transition or emission table of a model read by FrozenHMM.load.
+    The table stays in the memory-mapped CSR arrays, the dictionary of a tag is built from its row
+    the first time the tag is looked up, so loading takes no time and only the rows in use are read.
+    Answers get, [], in and iteration over the tags as the dictionary of dictionaries it replaces.
+    """
+
+    def __init__(self, stateIds, keys, indptr, indices, probs):
+        self.stateIds = stateIds  # tag: row
+        self.keys = keys  # tags or words of the columns
+        self.indptr = indptr
+        self.indices = indices
+        self.probs = probs
+        self.rows = {}
+
+    def get(self, y, default=None):
+        row = self.rows.get(y)
+        if row is None:
+            i = self.stateIds.get(y)
+            if i is None:
+                return default
+            a, b = int(self.indptr[i]), int(self.indptr[i + 1])
+            row = self.rows[y] = dict(zip(self.keys[self.indices[a:b]].tolist(), self.probs[a:b].tolist()))
+        return row
+
+    def __getitem__(self, y):
+        row = self.get(y)
+        if row is None:
+            raise KeyError(y)
+        return row
+
+    def __contains__(self, y):
+        return y in self.stateIds
+
+    def __iter__(self):
+        return iter(self.stateIds)
+
+    def __len__(self):
+        return len(self.stateIds)
+
+
+class FrozenHMM:
+    """
+    Read-only Hidden Markov Model made by HMM.freeze().
+    Stores the probabilities of the events seen in the training corpus and the frequencies of the tags.
+    Smoothed probabilities of unseen events are computed on lookup and are never written to the tables,
+    so the model doesn't grow while it is applied and can be shared between threads or forked processes.
+    """
+
+    def __init__(self, hmm=None):
+        self.states = {}
+        self.numObservations = 0
+        self.startProbabilities = {}
+        self.transitionProbabilities = {}
+        self.emissionProbabilities = {}
+        if hmm is None:
+            return
+        self.states = dict(hmm.states)
+        self.numObservations = len(hmm.observations)
+        self.startProbabilities = dict(hmm.startProbabilities)
+        self.transitionProbabilities = dict((y, dict(hmm.transitionProbabilities[y]))
+                                            for y in hmm.transitionProbabilities)
+        self.emissionProbabilities = dict((y, dict(hmm.emissionProbabilities[y]))
+                                          for y in hmm.emissionProbabilities)
+
+    def start(self, y):
+        return self.startProbabilities.get(y, 0)
+
+    def emission(self, y, word):
+        p = self.emissionProbabilities.get(y, {}).get(word)
+        if p is None:
+            p = 1 / (self.states.get(y, 0) + self.numObservations)
+        return p
+
+    def transition(self, y0, y):
+        p = self.transitionProbabilities.get(y0, {}).get(y)
+        if p is None:
+            p = 1 / (self.states.get(y, 0) + len(self.states))
+        return p
+
+    def save(self, path, observations=None):
+        """
+        Writes the model to the directory path as .npy arrays which can be memory-mapped:
+        states.npy and words.npy - sorted vocabularies of tags and words,
+        counts.npy - frequencies of the tags, start.npy - start probabilities,
+        transition and emission tables in CSR layout, one row per tag:
+        trans_indptr.npy, trans_indices.npy (tag ids), trans_probs.npy,
+        emit_indptr.npy, emit_indices.npy (word ids), emit_probs.npy.
+        Unseen words only count for the smoothing, so words.npy holds the words that have emissions
+        and the size of the vocabulary is kept in num_observations.npy.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        stateList = sorted(self.states)
+        stateIds = dict((y, i) for i, y in enumerate(stateList))
+        words = set()
+        for y in self.emissionProbabilities:
+            words.update(self.emissionProbabilities[y])
+        wordList = sorted(words)
+        wordIds = dict((w, i) for i, w in enumerate(wordList))
+
+        np.save(os.path.join(path, 'states.npy'), np.array(stateList, dtype=np.unicode_))
+        np.save(os.path.join(path, 'words.npy'), np.array(wordList, dtype=np.unicode_))
+        np.save(os.path.join(path, 'num_observations.npy'), np.array([self.numObservations], dtype=np.int64))
+        np.save(os.path.join(path, 'counts.npy'), np.array([self.states[y] for y in stateList], dtype=np.int64))
+        np.save(os.path.join(path, 'start.npy'), np.array([self.start(y) for y in stateList], dtype=np.float64))
+        for name, table, ids in (('trans', self.transitionProbabilities, stateIds),
+                                 ('emit', self.emissionProbabilities, wordIds)):
+            indptr = [0]
+            indices = []
+            probs = []
+            for y in stateList:
+                row = sorted((ids[x], p) for x, p in table.get(y, {}).iteritems() if x in ids)
+                indices += [i for i, p in row]
+                probs += [p for i, p in row]
+                indptr.append(len(indices))
+            np.save(os.path.join(path, name + '_indptr.npy'), np.array(indptr, dtype=np.int64))
+            np.save(os.path.join(path, name + '_indices.npy'), np.array(indices, dtype=np.int32))
+            np.save(os.path.join(path, name + '_probs.npy'), np.array(probs, dtype=np.float64))
+
+    @staticmethod
+    def load(path):
+        """
+        Reads a model written by FrozenHMM.save.
+        The tags, their counts and the start probabilities are read into dictionaries,
+        the transition and emission tables stay memory-mapped (see FrozenTable).
+        """
+        def array(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        model = FrozenHMM()
+        states = array('states')
+        stateList = states.tolist()
+        stateIds = dict((y, i) for i, y in enumerate(stateList))
+        model.numObservations = int(array('num_observations')[0])
+        model.states = dict(zip(stateList, array('counts').tolist()))
+        model.startProbabilities = dict(zip(stateList, array('start').tolist()))
+        model.transitionProbabilities = FrozenTable(stateIds, states, array('trans_indptr'),
+                                                    array('trans_indices'), array('trans_probs'))
+        model.emissionProbabilities = FrozenTable(stateIds, array('words'), array('emit_indptr'),
+                                                  array('emit_indices'), array('emit_probs'))
+        return model
+
+
 class ViterbiTrainer:
 
-    def __init__(self, hmm, path, extension='.xhtml'):
+    batchCells = 2 ** 22  # the largest (batch, state, state) array of scores viterbi_batch builds
+
+    def __init__(self, hmm, path, extension='.xhtml', lattice=False, vectorized=False, batch=0, workers=1):
+        """
+        Applies the Viterbi algorithm to all files in the directory.
+
+        hmm: trained HMM or FrozenHMM instance, an HMM is frozen before decoding
+        path: unicode string containing the path to the directory where the files to disambiguate are stored
+        extension: unicode string containing the ending of the filename, e.g. '.xhtml' or 'cheese.txt',
+                   this helps to identify files that need to be processed
+        lattice: True or False,
+                 False by default,
+                 if the value is True, the trellis at each position holds only the tags proposed for the word
+                 by the morphological parser (see viterbi_lattice), instead of all the tags of the model
+        vectorized: True or False,
+                    False by default,
+                    if the value is True, sentences are decoded with the NumPy kernel
+                    (see viterbi_vectorized), which returns the same tags as viterbi(),
+                    the kernel has no lattice mode, so lattice and vectorized can't be both True
+        batch: number of files whose sentences are decoded together (see viterbi_batch),
+               0 by default, which means that the sentences are decoded one by one,
+               batch decoding uses the NumPy kernel of vectorized and returns the same tags as viterbi(),
+               it has no lattice mode, so lattice can't be True with batch
+        workers: number of processes that decode and rewrite the files, 1 by default,
+                 if it is greater than 1, the files are spread over a multiprocessing pool
+                 (see viterbi_init_worker), the changes and the lines of res2.txt are collected here
+        """
+        if lattice and vectorized:
+            raise ValueError('lattice and vectorized decoding can not be combined')
+        if lattice and batch:
+            raise ValueError('lattice and batch decoding can not be combined')
         print "Run Viterbi Algorithm."
+        if isinstance(hmm, HMM):
+            hmm = hmm.freeze()
+        self.model = hmm
         self.states = hmm.states.keys()
         self.states2 = hmm.states
-        self.trans_p = hmm.transitionProbabilities
-        self.emit_p = hmm.emissionProbabilities
-        self.start_p = hmm.startProbabilities
-        self.observ = hmm.observations.keys()
         self.changes = 0
-        count = 0
+        self.lattice = lattice
+        if lattice:
+            self.wordStates = self.collect_word_states()
+        self.vectorized = vectorized
+        self.batch = batch
+        if vectorized or batch:
+            self.compile_model()
+        fileNames = []
         for root, dirs, files in os.walk(path):
             for fName in files:
                 if fName.endswith(extension):
-                    count += 1
-                    self.find_sents(os.path.join(root, fName))
-                    print "Applied ViterbiTrainer to %s, %s files." % (os.path.join(root, fName), count)
+                    fileNames.append(os.path.join(root, fName))
+        size = batch or 1
+        tasks = [fileNames[i:i + size] for i in xrange(0, len(fileNames), size)]
+        if workers > 1:
+            # the trainer goes to every worker once, when the pool starts, not with each task
+            pool = multiprocessing.Pool(workers, viterbi_init_worker, (self,))
+            results = pool.imap(viterbi_decode_files, tasks)
+        else:
+            results = (self.decode_files(task) for task in tasks)
+        count = 0
+        for task, taskResults in zip(tasks, results):
+            for f, (changes, trace) in zip(task, taskResults):
+                count += 1
+                self.write_trace(trace)
+                self.add_changes(changes)
+                print "Applied ViterbiTrainer to %s, %s files." % (f, count)
+        if workers > 1:
+            pool.close()
+            pool.join()
 
     def find_sents(self, f):
+        changes, trace = self.decode_file(f)
+        self.write_trace(trace)
+        self.add_changes(changes)
+
+    def decode_files(self, fNames):
+        """
+        Decodes and rewrites the files.
+        Returns a list of (number of changes, lines for res2.txt), one for each file.
+        """
+        if self.batch:
+            return self.decode_batch(fNames)
+        return [self.decode_file(f) for f in fNames]
+
+    def decode_file(self, f):
         changes = 0
         root = etree.parse(f).getroot()
-        f2 = codecs.open(u'res2.txt', 'a', 'utf-8')
+        trace = StringIO.StringIO()
+        for se, sent, sentWords in self.read_sents(root):
+            tags = self.decode(sent, sentWords)  # found most probable sequence of tags
+            changes += self.rewrite_sent(se, sent, sentWords, tags, trace)
+        self.write_file(f, root)
+        return changes, trace.getvalue()
+
+    def decode_batch(self, fNames):
+        """
+        Reads the sentences of several files, decodes all of them at once with viterbi_batch
+        and puts the results back to their sentences.
+        """
+        docs = []
+        sents = []
+        for f in fNames:
+            root = etree.parse(f).getroot()
+            docSents = self.read_sents(root)
+            docs.append((f, root, docSents))
+            sents += [sent for se, sent, sentWords in docSents]
+        tags = self.viterbi_batch(sents)
+        results = []
+        n = 0
+        for f, root, docSents in docs:
+            changes = 0
+            trace = StringIO.StringIO()
+            for se, sent, sentWords in docSents:
+                changes += self.rewrite_sent(se, sent, sentWords, tags[n], trace)
+                n += 1
+            self.write_file(f, root)
+            results.append((changes, trace.getvalue()))
+        return results
+
+    def read_sents(self, root):
+        """
+        Returns a list of (se, words, [(gr, ana), ...] for each word) for all sentences of the document.
+        """
+        sents = []
         for se in root[1]:
             sentWords = []
             sent = []
@@ -867,27 +2704,51 @@ class ViterbiTrainer:
                 sentWords.append([(ana.attrib['gr'], ana) for ana in se[w]
                                    if 'gr' in ana.attrib and ana.attrib['gr'] != ''])
                 sent.append(curW)
-            tags = self.viterbi(sent)  # found most probable sequence of tags
-            k = zip(sent, tags)
-            sentWords = self.delete_bad_tags(k, sentWords)
-            for c in xrange(len(sent)):
-                if c in sentWords:
-                    if sentWords[c] != []:
-                        for i in xrange(len(se[c])):  # ==for ana in word:
-                            se[c].remove(se[c][0])  # deleted all ana from the tree
-                        # print len(sentWords[c])
-                        for e in sentWords[c]:
-                            se[c].append(e)
-                        se[c][-1].tail = sent[c]
-                        changes += 1
-            for (a, b) in k:
-                f2.write(a + ' : ' + b + '\r\n')
-            f2.write(u'***********************************************************\r\n')
+            sents.append((se, sent, sentWords))
+        return sents
+
+    def decode(self, sent, sentWords):
+        if self.lattice:
+            return self.viterbi_lattice(sent, sentWords)
+        elif self.vectorized:
+            return self.viterbi_vectorized(sent)
+        return self.viterbi(sent)
+
+    def rewrite_sent(self, se, sent, sentWords, tags, f2):
+        """
+        Leaves only the anas with the found tags in the sentence and writes the tags to f2.
+        Returns the number of changes.
+        """
+        changes = 0
+        k = zip(sent, tags)
+        sentWords = self.delete_bad_tags(k, sentWords)
+        for c in xrange(len(sent)):
+            if c in sentWords:
+                if sentWords[c] != []:
+                    for i in xrange(len(se[c])):  # ==for ana in word:
+                        se[c].remove(se[c][0])  # deleted all ana from the tree
+                    # print len(sentWords[c])
+                    for e in sentWords[c]:
+                        se[c].append(e)
+                    se[c][-1].tail = sent[c]
+                    changes += 1
+        for (a, b) in k:
+            f2.write(a + ' : ' + b + '\r\n')
+        f2.write(u'***********************************************************\r\n')
+        return changes
+
+    def write_file(self, f, root):
         out = etree.tostring(root, pretty_print=True, encoding=unicode)
-        f2.close()
         fOut = codecs.open(f, 'w', 'utf-8')
         fOut.write(out)
         fOut.close()
+
+    def write_trace(self, trace):
+        f2 = codecs.open(u'res2.txt', 'a', 'utf-8')
+        f2.write(trace)
+        f2.close()
+
+    def add_changes(self, changes):
         self.changes += changes
         print "Made %s changes. Total: %s changes." % (changes, self.changes)
 
@@ -916,9 +2777,7 @@ class ViterbiTrainer:
 
         d = {}
         for y in self.states:
-            if obs[0] not in self.emit_p[y]:
-                self.emit_p[y][obs[0]] = 1 / (self.states2[y] + len(self.observ))
-            d[y] = (self.start_p[y] * self.emit_p[y][obs[0]])
+            d[y] = (self.model.start(y) * self.model.emission(y, obs[0]))
         V = [d]
         path = {y:[y] for y in self.states}
 
@@ -928,12 +2787,9 @@ class ViterbiTrainer:
 
             for y in self.states:
                 ar = []
+                e = self.model.emission(y, obs[t])
                 for y0 in self.states:
-                    if obs[t] not in self.emit_p[y]:
-                        self.emit_p[y][obs[t]] = 1 / (self.states2[y] + len(self.observ))
-                    if y not in self.trans_p[y0]:
-                        self.trans_p[y0][y] = 1 / (self.states2[y] + len(self.states))
-                    ar.append((V[t - 1][y0] * self.trans_p[y0][y] * self.emit_p[y][obs[t]], y0))
+                    ar.append((V[t - 1][y0] * self.model.transition(y0, y) * e, y0))
                 (prob, state) = max(ar)
                 V[t][y] = prob
                 newpath[y] = path[state] + [y]
@@ -943,4 +2799,255 @@ class ViterbiTrainer:
             n = t
 
         (prob, state) = max((V[n][y], y) for y in self.states)
-        return path[state]
\ No newline at end of file
+        return path[state]
+
+    def collect_word_states(self):
+        """
+        Returns a dictionary {word: [tags the word was seen with in the training corpus]}.
+        """
+        d = defaultdict(list)
+        for y in self.states:
+            for w in self.model.emissionProbabilities.get(y, {}):
+                d[w].append(y)
+        return d
+
+    def candidate_states(self, word, anas):
+        """
+        Returns the tags that the trellis holds for a word.
+        These are the tags proposed by the morphological parser that are known to the model.
+        If there are none, falls back to the tags the word was seen with in the training corpus,
+        and if the word is unknown too - to all the tags of the model.
+        """
+        cands = []
+        for gr, ana in anas:
+            if gr in self.states2 and gr not in cands:
+                cands.append(gr)
+        if cands == []:
+            cands = self.wordStates.get(word, [])
+        if cands == []:
+            cands = self.states
+        return cands
+
+    def viterbi_lattice(self, obs, sentWords):
+        """
+        Same as viterbi(), but at each position only the candidate tags of the word are scored,
+        so a sentence costs O(T*K*K) with K candidates per word instead of O(T*S*S).
+        """
+        lattice = [self.candidate_states(obs[t], sentWords[t]) for t in range(len(obs))]
+
+        V = {}
+        for y in lattice[0]:
+            V[y] = self.model.start(y) * self.model.emission(y, obs[0])
+        back = []
+
+        for t in range(1, len(obs)):
+            newV = {}
+            pointers = {}
+            for y in lattice[t]:
+                e = self.model.emission(y, obs[t])
+                ar = []
+                for y0 in V:
+                    ar.append((V[y0] * self.model.transition(y0, y) * e, y0))
+                (prob, state) = max(ar)
+                newV[y] = prob
+                pointers[y] = state
+            back.append(pointers)
+            V = newV
+
+        (prob, state) = max((V[y], y) for y in V)
+        tags = [state]
+        for pointers in reversed(back):
+            state = pointers[state]
+            tags.append(state)
+        tags.reverse()
+        return tags
+
+    def compile_model(self):
+        """
+        Turns the probability dictionaries into arrays indexed by integer tag ids:
+        start probabilities, a dense S x S transition matrix,
+        emissions of unseen words and, for every seen word, the ids and emissions of its tags.
+        Smoothing is the same as in viterbi().
+        """
+        print "Compiling the model..."
+        # max() over (prob, tag) tuples prefers the greater tag in case of a tie,
+        # argmax prefers the first index, so the tags are numbered in reverse order
+        self.tagList = sorted(self.states, reverse=True)
+        self.tagIds = dict((y, i) for i, y in enumerate(self.tagList))
+        nStates = len(self.tagList)
+        counts = np.array([self.states2[y] for y in self.tagList], dtype=np.float64)
+
+        self.startProbs = np.array([self.model.start(y) for y in self.tagList], dtype=np.float64)
+
+        trans = np.tile(1 / (counts + nStates), (nStates, 1))  # trans[y0, y]
+        for i in xrange(nStates):
+            for y, p in self.model.transitionProbabilities.get(self.tagList[i], {}).iteritems():
+                if y in self.tagIds:
+                    trans[i, self.tagIds[y]] = p
+        self.transProbs = trans
+
+        self.unseenProbs = 1 / (counts + self.model.numObservations)
+        words = defaultdict(list)
+        for i in xrange(nStates):
+            for w, p in self.model.emissionProbabilities.get(self.tagList[i], {}).iteritems():
+                words[w].append((i, p))
+        self.wordEmissions = {}
+        for w in words:
+            ids, probs = zip(*words[w])
+            self.wordEmissions[w] = (np.array(ids, dtype=np.int32), np.array(probs, dtype=np.float64))
+
+    def emission_column(self, word):
+        """
+        Returns the vector of emission probabilities of the word for all tags.
+        """
+        col = self.unseenProbs.copy()
+        if word in self.wordEmissions:
+            ids, probs = self.wordEmissions[word]
+            col[ids] = probs
+        return col
+
+    def viterbi_vectorized(self, obs):
+        """
+        Viterbi over integer tag ids.
+        Each time step is one argmax over the S x S matrix of scores,
+        the best path is restored from an int backpointer array instead of copying the paths.
+        The scores are products multiplied in the same order as in viterbi(), so equal paths stay equal
+        and the ties are broken in the same way (sums of logs may differ in the last bit).
+        Before each step the scores are divided by a power of two, which is exact,
+        so long sentences don't underflow. Doesn't write smoothed values to the model.
+        """
+        nStates = len(self.tagList)
+        columns = np.arange(nStates)
+        back = np.zeros((len(obs), nStates), dtype=np.int32)
+        delta = self.startProbs * self.emission_column(obs[0])
+        for t in xrange(1, len(obs)):
+            delta = np.ldexp(delta, -np.frexp(delta.max())[1])
+            scores = delta[:, np.newaxis] * self.transProbs  # scores[y0, y]
+            scores *= self.emission_column(obs[t])
+            back[t] = scores.argmax(axis=0)
+            delta = scores[back[t], columns]
+        state = int(delta.argmax())
+        path = [state]
+        for t in xrange(len(obs) - 1, 0, -1):
+            state = back[t, state]
+            path.append(state)
+        return [self.tagList[i] for i in reversed(path)]
+
+    def viterbi_batch(self, sents):
+        """
+        Decodes many sentences at once and returns their tags in the same order.
+        Sentences of the same length are stacked, so the recursion runs over (batch, time, state) arrays
+        with one argmax per time step for the whole group (see viterbi_stack).
+        """
+        nStates = len(self.tagList)
+        maxBatch = max(1, self.batchCells // (nStates * nStates))
+        byLength = defaultdict(list)
+        for i in xrange(len(sents)):
+            byLength[len(sents[i])].append(i)
+        result = [None] * len(sents)
+        for length in byLength:
+            group = byLength[length]
+            for b in xrange(0, len(group), maxBatch):
+                ids = group[b:b + maxBatch]
+                emissions = np.array([[self.emission_column(w) for w in sents[i]] for i in ids])
+                paths = self.viterbi_stack(emissions)
+                for i, path in zip(ids, paths):
+                    result[i] = [self.tagList[y] for y in path]
+        return result
+
+    def viterbi_stack(self, emissions):
+        """
+        Viterbi for a (batch, time, state) array of emissions of sentences of equal length,
+        the scores are computed and rescaled as in viterbi_vectorized, every sentence with its own power of two.
+        Returns a (batch, time) array of tag ids.
+        """
+        nBatch, length, nStates = emissions.shape
+        back = np.zeros((nBatch, length, nStates), dtype=np.int32)
+        delta = self.startProbs * emissions[:, 0]
+        for t in xrange(1, length):
+            delta = np.ldexp(delta, -np.frexp(delta.max(axis=1))[1][:, np.newaxis])
+            scores = delta[:, :, np.newaxis] * self.transProbs * emissions[:, t, np.newaxis]  # scores[b, y0, y]
+            back[:, t] = scores.argmax(axis=1)
+            delta = scores.max(axis=1)
+        paths = np.zeros((nBatch, length), dtype=np.int32)
+        paths[:, -1] = delta.argmax(axis=1)
+        rows = np.arange(nBatch)
+        for t in xrange(length - 1, 0, -1):
+            paths[:, t - 1] = back[rows, t, paths[:, t]]
+        return paths
+
+
+def viterbi_init_worker(trainer):
+    """
+    Runs once in every worker process of ViterbiTrainer and keeps the trainer for the tasks.
+    """
+    global workerTrainer
+    workerTrainer = trainer
+
+
+def viterbi_decode_files(fNames):
+    """
+    Runs in a worker process of ViterbiTrainer, decodes and rewrites a group of files.
+    """
+    return workerTrainer.decode_files(fNames)
+
+
+#************************************#
+# Training - One Corpus Scan         #
+#************************************#
+
+class CorpusScan:
+    """
+    Parses every corpus file once and pushes each sentence to all registered collectors,
+    so that the bigrams, the Brill corpus and the HMM counts are collected in one pass instead of three.
+    path may also be a cache made by corpus.compile_corpus.
+
+    A collector has methods start_file(fName), collect_sentence(sent) and end_file(fName),
+    sent is a list of (wordform, [attributes of ana, ...]) as yielded by iter_sentences.
+    The sentences are shared between the collectors, so a collector must not change them.
+
+    scan = CorpusScan()
+    bigrams = scan.register(GoodBigramsTrainer(None))
+    brill = scan.register(BrillTrainer())
+    hmm = scan.register(HMM(None))
+    scan.run(u'C:\\corpus')
+    hmm.finish()
+    """
+
+    def __init__(self):
+        self.collectors = []
+
+    def register(self, collector):
+        self.collectors.append(collector)
+        return collector
+
+    def run(self, path, extension='.xhtml'):
+        count = 0
+        for fName, sents in iter_corpus(path, extension):
+            for collector in self.collectors:
+                collector.start_file(fName)
+            for sent in sents:
+                for collector in self.collectors:
+                    collector.collect_sentence(sent)
+            for collector in self.collectors:
+                collector.end_file(fName)
+            count += 1
+        print "Scanned %s files." % count
+
+
+def train_all(path, extension='.xhtml', ambig=True):
+    """
+    Collects the statistics for all three models in one scan of the corpus.
+    Returns (GoodBigramsTrainer, BrillTrainer, HMM), the same as
+    GoodBigramsTrainer(path), BrillTrainer().make_POS_file(path) and HMM(path, ambig=ambig) would give.
+    """
+    scan = CorpusScan()
+    bigrams = scan.register(GoodBigramsTrainer(None))
+    brill = scan.register(BrillTrainer())
+    hmm = scan.register(HMM(None, ambig=ambig))
+    print 'Collecting good bigrams, Brill corpus and HMM statistics...'
+    scan.run(path, extension)
+    print 'Good bigrams collected. Total: %s bigrams.\r\n' % (bigrams.total)
+    print 'Corpus created.\r\n'
+    hmm.finish()
+    return bigrams, brill, hmm
@@ -13,7 +13,11 @@ __author__ = 'elmira'
 
 import os
 import codecs
+import StringIO
+import multiprocessing
+import numpy as np
 from lxml import etree
+from corpus import iter_sentences, iter_corpus, corpus_files
 from collections import defaultdict
 
 #************************************#
@@ -22,13 +26,14 @@ from collections import defaultdict
 
 class HMM:
 
-    def __init__(self, path, extension='.xhtml', printing=False, ambig=True):
+    def __init__(self, path, extension='.xhtml', printing=False, ambig=True, workers=1):
 
         """
         Creates a Hidden Markov Model.
         Starts the search.
 
-        path: unicode string containing the path to the directory where the corpus files are stored
+        path: unicode string containing the path to the directory where the corpus files are stored,
+              or to a cache made by corpus.compile_corpus
         extension: unicode string containing the ending of the filename, e.g. '.xhtml' or 'cheese.txt',
                    this helps to identify files that need to be searched
         printing: True or False,
@@ -37,6 +42,9 @@ class HMM:
         ambig: True or False,
                True by default, searches only non ambiguous unigrams and bigrams
                if the value is False, assumes that the corpus is manually disambiguated and each word has correct tag
+        workers: number of processes that collect the statistics, 1 by default,
+                 if it is greater than 1, the files are spread over a multiprocessing pool (see collect_parallel)
+        If path is None, creates an empty model without probabilities, the workers collect their counts into it.
         """
         self.states = defaultdict(int)
         self.observations = defaultdict(int)
@@ -44,27 +52,36 @@ class HMM:
         self.transitionProbabilities = defaultdict(dict)
         self.startProbabilities = defaultdict(int)
         self.starts = 0
+        self.ambig = ambig
+        self.lastTags = (None, None)
+        if path is None:
+            return
 
         print 'Collecting statistics...'
-        if ambig:
+        if workers > 1:
+            self.collect_parallel(path, extension, ambig, workers)
+        elif ambig:
             count = 0
-            for root, dirs, files in os.walk(path):
-                for fName in files:
-                    if fName.endswith(extension):
-                        count += 1
-                        self.search_file_ambig(os.path.join(root, fName))
-                        if count % 300 == 0:
-                            print "Processed %s files." % count
+            for fName, sents in iter_corpus(path, extension):
+                count += 1
+                self.search_file_ambig(fName, sents)
+                if count % 300 == 0:
+                    print "Processed %s files." % count
         elif ambig is False:
             count = 0
-            for root, dirs, files in os.walk(path):
-                for fName in files:
-                    if fName.endswith(extension):
-                        count += 1
-                        self.search_file_not_ambig(os.path.join(root, fName))
-                        if count % 100 == 0:
-                            print "Processed %s files." % count
+            for fName, sents in iter_corpus(path, extension):
+                count += 1
+                self.search_file_not_ambig(fName, sents)
+                if count % 100 == 0:
+                    print "Processed %s files." % count
         # print 'Good bigrams collected. Total: %s bigrams.\r\n' % (len(self.goodBigrs))
+        self.finish(printing)
+
+    def finish(self, printing=False):
+        """
+        Turns the collected counts into probabilities.
+        Is called by __init__ after the search, or after the corpus scan when the model is filled sentence by sentence.
+        """
         print 'Collected %s tags' % len(self.states)
         print 'Collected %s words' % len(self.observations)
         print 'Collecting emission and transition probabilities...'
@@ -74,115 +91,184 @@ class HMM:
         if printing:
             self.printing()
 
-    def search_file_ambig(self, fName):
+    def start_file(self, fName):
         """
-        Performs the search of good bigrams in a given file fName.
-        Writes the result to the array goodBigrs.
+        Starts a new file when the model is filled sentence by sentence (see collect_sentence).
         """
-        # try:
-        root = etree.parse(fName).getroot()
-        for se in root[1]:
-            for w in range(len(se) - 1):
+        self.lastTags = (None, None)
 
-                curWord = [ana for ana in se[w] if "lex" in ana.attrib]
-                curWord1 = [ana for ana in se[w]]
-                curW = curWord1[-1].tail
-                self.observations[curW] += 1
-                curResult = False
-                if curWord != []:
-                    curPoS = set([x.attrib["gr"].split(u',')[0] for x in curWord])
-                    if (curPoS == {"V", "ADV"} or curPoS == {"PREP", "PRON"} or curPoS == {"V", "PRON"}) and len(
-                            curWord) == 2:  # treating special cases right
-                        curResult = True
+    def collect_sentence(self, se):
+        """
+        Collects the counts from one sentence se, as search_file_ambig or search_file_not_ambig does.
+        """
+        if self.ambig:
+            self.search_sent_ambig(se)
+        else:
+            self.search_sent_not_ambig(se)
 
-                    if len(curWord) == 1 or curResult:
+    def end_file(self, fName):
+        pass
 
-                        try:
-                            curT = curWord[-1].attrib["gr"]
-                            if curT != '':
-                                self.states[curT] += 1
-                                try:
-                                    self.emissionProbabilities[curT][curW] += 1
-                                except KeyError:
-                                    self.emissionProbabilities[curT][curW] = 1
-                        except KeyError:
-                            pass
+    def collect_parallel(self, path, extension, ambig, workers):
+        """
+        Spreads the files over a pool of worker processes.
+        Each worker returns the counts for its files (see hmm_count_files), and the counts are summed,
+        so the result is the same as that of the serial search.
+        """
+        fNames = corpus_files(path, extension)
+        size = max(1, len(fNames) // (workers * 4))
+        tasks = [(path, extension, fNames[i:i + size], ambig) for i in xrange(0, len(fNames), size)]
+        pool = multiprocessing.Pool(workers)
+        count = 0
+        for shard in pool.imap_unordered(hmm_count_files, tasks):
+            self.merge_counts(shard)
+            count += shard[0]
+            print "Processed %s files." % count
+        pool.close()
+        pool.join()
+
+    def counts(self):
+        """
+        Returns the collected counts as plain dictionaries:
+        (tags, words, {tag: {word: count}}, {tag: {next tag: count}}).
+        """
+        return (dict(self.states), dict(self.observations),
+                dict(self.emissionProbabilities), dict(self.transitionProbabilities))
 
-                nextWord = [ana for ana in se[w + 1] if
-                            "lex" in ana.attrib]  # not counting empty tags
-                nextWord1 = [ana for ana in se[w + 1]]
-                nextW = nextWord1[-1].tail
-                if w == len(se) - 1:
-                    self.observations[nextW] += 1
-                nextResult = False
-                if nextWord != []:
-                    nextPoS = set([x.attrib["gr"].split(u',')[0] for x in nextWord])
-                    if (nextPoS == {"V", "ADV"} or nextPoS == {"PREP", "PRON"} or nextPoS == {"V", "PRON"}) and len(
-                            nextWord) == 2:
-                        nextResult = True
-                    if len(nextWord) == 1 or nextResult:
-                        nextT = nextWord[-1].attrib["gr"]
-
-                        if w == len(se) - 1:
-                            if nextT != '':
-                                self.states[nextT] += 1
+    def merge_counts(self, shard):
+        """
+        Adds the counts returned by hmm_count_files to the counts of the model.
+        """
+        states, observations, emission, transition = shard[1]
+        for k, v in states.iteritems():
+            self.states[k] += v
+        for k, v in observations.iteritems():
+            self.observations[k] += v
+        for table, counts in ((self.emissionProbabilities, emission), (self.transitionProbabilities, transition)):
+            for k, row in counts.iteritems():
+                target = table[k]
+                for x, v in row.iteritems():
+                    target[x] = target.get(x, 0) + v
+
+    def search_file_ambig(self, fName, sents=None):
+        """
+        Collects the counts from a given file fName sentence by sentence (see search_sent_ambig).
+        sents: the sentences of the file if they are already read (see iter_corpus), otherwise the file is parsed.
+        """
+        self.lastTags = (None, None)
+        if sents is None:
+            sents = iter_sentences(fName)
+        for se in sents:
+            self.search_sent_ambig(se)
 
-                try:
-                    if (len(nextWord) == 1 or nextResult) and nextT != '' and curT != '':
-                        if len(curWord) == 1 or curResult:
-                            try:
-                                self.transitionProbabilities[curT][nextT] += 1
-                            except KeyError:
-                                self.transitionProbabilities[curT][nextT] = 1
-                except UnboundLocalError:
-                    pass
+    def search_sent_ambig(self, se):
+        """
+        Collects the counts from one sentence se, a list of (wordform, [attributes of ana, ...]).
+        Only non ambiguous words and bigrams are counted.
+        The last tags seen are kept in lastTags and carried over to the next sentence of the file.
+        """
+        curT, nextT = self.lastTags
+        for w in range(len(se) - 1):
 
-        # except:
-        #     print "Class - HMM; function - search_file_ambig(filename); fail at %s" % fName
+            curWord = [ana for ana in se[w][1] if "lex" in ana]
+            curW = se[w][0]
+            self.observations[curW] += 1
+            curResult = False
+            if curWord != []:
+                curPoS = set([x["gr"].split(u',')[0] for x in curWord])
+                if (curPoS == {"V", "ADV"} or curPoS == {"PREP", "PRON"} or curPoS == {"V", "PRON"}) and len(
+                        curWord) == 2:  # treating special cases right
+                    curResult = True
+
+                if len(curWord) == 1 or curResult:
 
-    def search_file_not_ambig(self, fName):
-        """
-                Performs the search of good bigrams in a given file fName.
-                Writes the result to the array goodBigrs.
-                """
-        # try:
-        root = etree.parse(fName).getroot()
-        for se in root[1]:
-            for w in range(len(se) - 1):
-                curWord = [ana for ana in se[w] if "lex" in ana.attrib]
-                if curWord != []:
-                    curW = curWord[-1].tail
-                    self.observations[curW] += 1
                     try:
-                        curT = curWord[-1].attrib["gr"]
+                        curT = curWord[-1]["gr"]
                         if curT != '':
                             self.states[curT] += 1
                             try:
                                 self.emissionProbabilities[curT][curW] += 1
                             except KeyError:
                                 self.emissionProbabilities[curT][curW] = 1
-                    except:
+                    except KeyError:
                         pass
 
-                nextWord = [ana for ana in se[w + 1] if
-                            "lex" in ana.attrib]  # not counting empty tags
-                if nextWord != []:
-                    nextW = nextWord[-1].tail
-                    nextT = nextWord[-1].attrib["gr"]
+            nextWord = [ana for ana in se[w + 1][1] if
+                        "lex" in ana]  # not counting empty tags
+            nextW = se[w + 1][0]
+            if w == len(se) - 1:
+                self.observations[nextW] += 1
+            nextResult = False
+            if nextWord != []:
+                nextPoS = set([x["gr"].split(u',')[0] for x in nextWord])
+                if (nextPoS == {"V", "ADV"} or nextPoS == {"PREP", "PRON"} or nextPoS == {"V", "PRON"}) and len(
+                        nextWord) == 2:
+                    nextResult = True
+                if len(nextWord) == 1 or nextResult:
+                    nextT = nextWord[-1]["gr"]
+
                     if w == len(se) - 1:
-                        self.observations[nextW] += 1
                         if nextT != '':
                             self.states[nextT] += 1
 
-                if nextWord != [] and curWord != [] and nextT != '' and curT != '':
-
+            if (len(nextWord) == 1 or nextResult) and None not in (curT, nextT) and nextT != '' and curT != '':
+                if len(curWord) == 1 or curResult:
                     try:
                         self.transitionProbabilities[curT][nextT] += 1
                     except KeyError:
                         self.transitionProbabilities[curT][nextT] = 1
+        self.lastTags = (curT, nextT)
+
+    def search_file_not_ambig(self, fName, sents=None):
+        """
+        Collects the counts from a given file fName sentence by sentence (see search_sent_not_ambig).
+        sents: the sentences of the file if they are already read (see iter_corpus), otherwise the file is parsed.
+        """
+        self.lastTags = (None, None)
+        if sents is None:
+            sents = iter_sentences(fName)
+        for se in sents:
+            self.search_sent_not_ambig(se)
+
+    def search_sent_not_ambig(self, se):
+        """
+        Collects the counts from one sentence se of a manually disambiguated corpus.
+        The last tags seen are kept in lastTags and carried over to the next sentence of the file.
+        """
+        curT, nextT = self.lastTags
+        for w in range(len(se) - 1):
+            curWord = [ana for ana in se[w][1] if "lex" in ana]
+            if curWord != []:
+                curW = se[w][0]
+                self.observations[curW] += 1
+                try:
+                    curT = curWord[-1]["gr"]
+                    if curT != '':
+                        self.states[curT] += 1
+                        try:
+                            self.emissionProbabilities[curT][curW] += 1
+                        except KeyError:
+                            self.emissionProbabilities[curT][curW] = 1
+                except:
+                    pass
+
+            nextWord = [ana for ana in se[w + 1][1] if
+                        "lex" in ana]  # not counting empty tags
+            if nextWord != []:
+                nextW = se[w + 1][0]
+                nextT = nextWord[-1]["gr"]
+                if w == len(se) - 1:
+                    self.observations[nextW] += 1
+                    if nextT != '':
+                        self.states[nextT] += 1
 
-                            # except:
-                            #     print "Class - HMM; function - search_file_ambig(filename); fail at %s" % fName
+            if nextWord != [] and curWord != [] and None not in (curT, nextT) and nextT != '' and curT != '':
+
+                try:
+                    self.transitionProbabilities[curT][nextT] += 1
+                except KeyError:
+                    self.transitionProbabilities[curT][nextT] = 1
+        self.lastTags = (curT, nextT)
 
     def collect_emission(self):
         '''
@@ -253,29 +339,312 @@ class HMM:
                 f.write('    ' + str(self.transitionProbabilities[k][w]) + '    ' + w + '\r\n')
         f.close()
 
+    def freeze(self):
+        """
+        Returns a read-only FrozenHMM with the same probabilities.
+        """
+        return FrozenHMM(self)
+
+    def save(self, path):
+        """
+        Writes the model to the directory path (see FrozenHMM.save).
+        """
+        self.freeze().save(path)
+
+    @staticmethod
+    def load(path):
+        """
+        Reads a model written by HMM.save and returns it as a FrozenHMM, no retraining needed.
+        """
+        return FrozenHMM.load(path)
+
+
+
+def hmm_count_files(args):
+    """
+    Runs in a worker process of HMM.collect_parallel.
+    Collects the counts of a list of files into an empty HMM and returns (number of files, counts).
+    """
+    path, extension, fNames, ambig = args
+    shard = HMM(None)
+    for fName, sents in iter_corpus(path, extension, fNames):
+        if ambig:
+            shard.search_file_ambig(fName, sents)
+        elif ambig is False:
+            shard.search_file_not_ambig(fName, sents)
+    return len(fNames), shard.counts()
+
+
+class FrozenTable:
+    """
+    Transition or emission table of a model read by FrozenHMM.load.
+    The table stays in the memory-mapped CSR arrays, the dictionary of a tag is built from its row
+    the first time the tag is looked up, so loading takes no time and only the rows in use are read.
+    Answers get, [], in and iteration over the tags as the dictionary of dictionaries it replaces.
+    """
+
+    def __init__(self, stateIds, keys, indptr, indices, probs):
+        self.stateIds = stateIds  # tag: row
+        self.keys = keys  # tags or words of the columns
+        self.indptr = indptr
+        self.indices = indices
+        self.probs = probs
+        self.rows = {}
+
+    def get(self, y, default=None):
+        row = self.rows.get(y)
+        if row is None:
+            i = self.stateIds.get(y)
+            if i is None:
+                return default
+            a, b = int(self.indptr[i]), int(self.indptr[i + 1])
+            row = self.rows[y] = dict(zip(self.keys[self.indices[a:b]].tolist(), self.probs[a:b].tolist()))
+        return row
+
+    def __getitem__(self, y):
+        row = self.get(y)
+        if row is None:
+            raise KeyError(y)
+        return row
+
+    def __contains__(self, y):
+        return y in self.stateIds
+
+    def __iter__(self):
+        return iter(self.stateIds)
+
+    def __len__(self):
+        return len(self.stateIds)
+
+
+class FrozenHMM:
+    """
+    Read-only Hidden Markov Model made by HMM.freeze().
+    Stores the probabilities of the events seen in the training corpus and the frequencies of the tags.
+    Smoothed probabilities of unseen events are computed on lookup and are never written to the tables,
+    so the model doesn't grow while it is applied and can be shared between threads or forked processes.
+    """
+
+    def __init__(self, hmm=None):
+        self.states = {}
+        self.numObservations = 0
+        self.startProbabilities = {}
+        self.transitionProbabilities = {}
+        self.emissionProbabilities = {}
+        if hmm is None:
+            return
+        self.states = dict(hmm.states)
+        self.numObservations = len(hmm.observations)
+        self.startProbabilities = dict(hmm.startProbabilities)
+        self.transitionProbabilities = dict((y, dict(hmm.transitionProbabilities[y]))
+                                            for y in hmm.transitionProbabilities)
+        self.emissionProbabilities = dict((y, dict(hmm.emissionProbabilities[y]))
+                                          for y in hmm.emissionProbabilities)
+
+    def start(self, y):
+        return self.startProbabilities.get(y, 0)
+
+    def emission(self, y, word):
+        p = self.emissionProbabilities.get(y, {}).get(word)
+        if p is None:
+            p = 1 / (self.states.get(y, 0) + self.numObservations)
+        return p
+
+    def transition(self, y0, y):
+        p = self.transitionProbabilities.get(y0, {}).get(y)
+        if p is None:
+            p = 1 / (self.states.get(y, 0) + len(self.states))
+        return p
+
+    def save(self, path, observations=None):
+        """
+        Writes the model to the directory path as .npy arrays which can be memory-mapped:
+        states.npy and words.npy - sorted vocabularies of tags and words,
+        counts.npy - frequencies of the tags, start.npy - start probabilities,
+        transition and emission tables in CSR layout, one row per tag:
+        trans_indptr.npy, trans_indices.npy (tag ids), trans_probs.npy,
+        emit_indptr.npy, emit_indices.npy (word ids), emit_probs.npy.
+        Unseen words only count for the smoothing, so words.npy holds the words that have emissions
+        and the size of the vocabulary is kept in num_observations.npy.
+        """
+        if not os.path.exists(path):
+            os.makedirs(path)
+        stateList = sorted(self.states)
+        stateIds = dict((y, i) for i, y in enumerate(stateList))
+        words = set()
+        for y in self.emissionProbabilities:
+            words.update(self.emissionProbabilities[y])
+        wordList = sorted(words)
+        wordIds = dict((w, i) for i, w in enumerate(wordList))
+
+        np.save(os.path.join(path, 'states.npy'), np.array(stateList, dtype=np.unicode_))
+        np.save(os.path.join(path, 'words.npy'), np.array(wordList, dtype=np.unicode_))
+        np.save(os.path.join(path, 'num_observations.npy'), np.array([self.numObservations], dtype=np.int64))
+        np.save(os.path.join(path, 'counts.npy'), np.array([self.states[y] for y in stateList], dtype=np.int64))
+        np.save(os.path.join(path, 'start.npy'), np.array([self.start(y) for y in stateList], dtype=np.float64))
+        for name, table, ids in (('trans', self.transitionProbabilities, stateIds),
+                                 ('emit', self.emissionProbabilities, wordIds)):
+            indptr = [0]
+            indices = []
+            probs = []
+            for y in stateList:
+                row = sorted((ids[x], p) for x, p in table.get(y, {}).iteritems() if x in ids)
+                indices += [i for i, p in row]
+                probs += [p for i, p in row]
+                indptr.append(len(indices))
+            np.save(os.path.join(path, name + '_indptr.npy'), np.array(indptr, dtype=np.int64))
+            np.save(os.path.join(path, name + '_indices.npy'), np.array(indices, dtype=np.int32))
+            np.save(os.path.join(path, name + '_probs.npy'), np.array(probs, dtype=np.float64))
+
+    @staticmethod
+    def load(path):
+        """
+        Reads a model written by FrozenHMM.save.
+        The tags, their counts and the start probabilities are read into dictionaries,
+        the transition and emission tables stay memory-mapped (see FrozenTable).
+        """
+        def array(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        model = FrozenHMM()
+        states = array('states')
+        stateList = states.tolist()
+        stateIds = dict((y, i) for i, y in enumerate(stateList))
+        model.numObservations = int(array('num_observations')[0])
+        model.states = dict(zip(stateList, array('counts').tolist()))
+        model.startProbabilities = dict(zip(stateList, array('start').tolist()))
+        model.transitionProbabilities = FrozenTable(stateIds, states, array('trans_indptr'),
+                                                    array('trans_indices'), array('trans_probs'))
+        model.emissionProbabilities = FrozenTable(stateIds, array('words'), array('emit_indptr'),
+                                                  array('emit_indices'), array('emit_probs'))
+        return model
+
+
 class ViterbiTrainer:
 
-    def __init__(self, hmm, path, extension='.xhtml'):
+    batchCells = 2 ** 22  # the largest (batch, state, state) array of scores viterbi_batch builds
+
+    def __init__(self, hmm, path, extension='.xhtml', lattice=False, vectorized=False, batch=0, workers=1):
+        """
+        Applies the Viterbi algorithm to all files in the directory.
+
+        hmm: trained HMM or FrozenHMM instance, an HMM is frozen before decoding
+        path: unicode string containing the path to the directory where the files to disambiguate are stored
+        extension: unicode string containing the ending of the filename, e.g. '.xhtml' or 'cheese.txt',
+                   this helps to identify files that need to be processed
+        lattice: True or False,
+                 False by default,
+                 if the value is True, the trellis at each position holds only the tags proposed for the word
+                 by the morphological parser (see viterbi_lattice), instead of all the tags of the model
+        vectorized: True or False,
+                    False by default,
+                    if the value is True, sentences are decoded with the NumPy kernel
+                    (see viterbi_vectorized), which returns the same tags as viterbi(),
+                    the kernel has no lattice mode, so lattice and vectorized can't be both True
+        batch: number of files whose sentences are decoded together (see viterbi_batch),
+               0 by default, which means that the sentences are decoded one by one,
+               batch decoding uses the NumPy kernel of vectorized and returns the same tags as viterbi(),
+               it has no lattice mode, so lattice can't be True with batch
+        workers: number of processes that decode and rewrite the files, 1 by default,
+                 if it is greater than 1, the files are spread over a multiprocessing pool
+                 (see viterbi_init_worker), the changes and the lines of res2.txt are collected here
+        """
+        if lattice and vectorized:
+            raise ValueError('lattice and vectorized decoding can not be combined')
+        if lattice and batch:
+            raise ValueError('lattice and batch decoding can not be combined')
         print "Run Viterbi Algorithm."
+        if isinstance(hmm, HMM):
+            hmm = hmm.freeze()
+        self.model = hmm
         self.states = hmm.states.keys()
         self.states2 = hmm.states
-        self.trans_p = hmm.transitionProbabilities
-        self.emit_p = hmm.emissionProbabilities
-        self.start_p = hmm.startProbabilities
-        self.observ = hmm.observations.keys()
         self.changes = 0
-        count = 0
+        self.lattice = lattice
+        if lattice:
+            self.wordStates = self.collect_word_states()
+        self.vectorized = vectorized
+        self.batch = batch
+        if vectorized or batch:
+            self.compile_model()
+        fileNames = []
         for root, dirs, files in os.walk(path):
             for fName in files:
                 if fName.endswith(extension):
-                    count += 1
-                    self.find_sents(os.path.join(root, fName))
-                    print "Applied ViterbiTrainer to %s, %s files." % (os.path.join(root, fName), count)
+                    fileNames.append(os.path.join(root, fName))
+        size = batch or 1
+        tasks = [fileNames[i:i + size] for i in xrange(0, len(fileNames), size)]
+        if workers > 1:
+            # the trainer goes to every worker once, when the pool starts, not with each task
+            pool = multiprocessing.Pool(workers, viterbi_init_worker, (self,))
+            results = pool.imap(viterbi_decode_files, tasks)
+        else:
+            results = (self.decode_files(task) for task in tasks)
+        count = 0
+        for task, taskResults in zip(tasks, results):
+            for f, (changes, trace) in zip(task, taskResults):
+                count += 1
+                self.write_trace(trace)
+                self.add_changes(changes)
+                print "Applied ViterbiTrainer to %s, %s files." % (f, count)
+        if workers > 1:
+            pool.close()
+            pool.join()
 
     def find_sents(self, f):
+        changes, trace = self.decode_file(f)
+        self.write_trace(trace)
+        self.add_changes(changes)
+
+    def decode_files(self, fNames):
+        """
+        Decodes and rewrites the files.
+        Returns a list of (number of changes, lines for res2.txt), one for each file.
+        """
+        if self.batch:
+            return self.decode_batch(fNames)
+        return [self.decode_file(f) for f in fNames]
+
+    def decode_file(self, f):
         changes = 0
         root = etree.parse(f).getroot()
-        f2 = codecs.open(u'res2.txt', 'a', 'utf-8')
+        trace = StringIO.StringIO()
+        for se, sent, sentWords in self.read_sents(root):
+            tags = self.decode(sent, sentWords)  # found most probable sequence of tags
+            changes += self.rewrite_sent(se, sent, sentWords, tags, trace)
+        self.write_file(f, root)
+        return changes, trace.getvalue()
+
+    def decode_batch(self, fNames):
+        """
+        Reads the sentences of several files, decodes all of them at once with viterbi_batch
+        and puts the results back to their sentences.
+        """
+        docs = []
+        sents = []
+        for f in fNames:
+            root = etree.parse(f).getroot()
+            docSents = self.read_sents(root)
+            docs.append((f, root, docSents))
+            sents += [sent for se, sent, sentWords in docSents]
+        tags = self.viterbi_batch(sents)
+        results = []
+        n = 0
+        for f, root, docSents in docs:
+            changes = 0
+            trace = StringIO.StringIO()
+            for se, sent, sentWords in docSents:
+                changes += self.rewrite_sent(se, sent, sentWords, tags[n], trace)
+                n += 1
+            self.write_file(f, root)
+            results.append((changes, trace.getvalue()))
+        return results
+
+    def read_sents(self, root):
+        """
+        Returns a list of (se, words, [(gr, ana), ...] for each word) for all sentences of the document.
+        """
+        sents = []
         for se in root[1]:
             sentWords = []
             sent = []
@@ -285,27 +654,51 @@ class ViterbiTrainer:
                 sentWords.append([(ana.attrib['gr'], ana) for ana in se[w]
                                    if 'gr' in ana.attrib and ana.attrib['gr'] != ''])
                 sent.append(curW)
-            tags = self.viterbi(sent)  # found most probable sequence of tags
-            k = zip(sent, tags)
-            sentWords = self.delete_bad_tags(k, sentWords)
-            for c in xrange(len(sent)):
-                if c in sentWords:
-                    if sentWords[c] != []:
-                        for i in xrange(len(se[c])):  # ==for ana in word:
-                            se[c].remove(se[c][0])  # deleted all ana from the tree
-                        # print len(sentWords[c])
-                        for e in sentWords[c]:
-                            se[c].append(e)
-                        se[c][-1].tail = sent[c]
-                        changes += 1
-            for (a, b) in k:
-                f2.write(a + ' : ' + b + '\r\n')
-            f2.write(u'***********************************************************\r\n')
+            sents.append((se, sent, sentWords))
+        return sents
+
+    def decode(self, sent, sentWords):
+        if self.lattice:
+            return self.viterbi_lattice(sent, sentWords)
+        elif self.vectorized:
+            return self.viterbi_vectorized(sent)
+        return self.viterbi(sent)
+
+    def rewrite_sent(self, se, sent, sentWords, tags, f2):
+        """
+        Leaves only the anas with the found tags in the sentence and writes the tags to f2.
+        Returns the number of changes.
+        """
+        changes = 0
+        k = zip(sent, tags)
+        sentWords = self.delete_bad_tags(k, sentWords)
+        for c in xrange(len(sent)):
+            if c in sentWords:
+                if sentWords[c] != []:
+                    for i in xrange(len(se[c])):  # ==for ana in word:
+                        se[c].remove(se[c][0])  # deleted all ana from the tree
+                    # print len(sentWords[c])
+                    for e in sentWords[c]:
+                        se[c].append(e)
+                    se[c][-1].tail = sent[c]
+                    changes += 1
+        for (a, b) in k:
+            f2.write(a + ' : ' + b + '\r\n')
+        f2.write(u'***********************************************************\r\n')
+        return changes
+
+    def write_file(self, f, root):
         out = etree.tostring(root, pretty_print=True, encoding=unicode)
-        f2.close()
         fOut = codecs.open(f, 'w', 'utf-8')
         fOut.write(out)
         fOut.close()
+
+    def write_trace(self, trace):
+        f2 = codecs.open(u'res2.txt', 'a', 'utf-8')
+        f2.write(trace)
+        f2.close()
+
+    def add_changes(self, changes):
         self.changes += changes
         print "Made %s changes. Total: %s changes." % (changes, self.changes)
 
@@ -334,9 +727,7 @@ class ViterbiTrainer:
 
         d = {}
         for y in self.states:
-            if obs[0] not in self.emit_p[y]:
-                self.emit_p[y][obs[0]] = 1 / (self.states2[y] + len(self.observ))
-            d[y] = (self.start_p[y] * self.emit_p[y][obs[0]])
+            d[y] = (self.model.start(y) * self.model.emission(y, obs[0]))
         V = [d]
         path = {y:[y] for y in self.states}
 
@@ -346,12 +737,9 @@ class ViterbiTrainer:
 
             for y in self.states:
                 ar = []
+                e = self.model.emission(y, obs[t])
                 for y0 in self.states:
-                    if obs[t] not in self.emit_p[y]:
-                        self.emit_p[y][obs[t]] = 1 / (self.states2[y] + len(self.observ))
-                    if y not in self.trans_p[y0]:
-                        self.trans_p[y0][y] = 1 / (self.states2[y] + len(self.states))
-                    ar.append((V[t - 1][y0] * self.trans_p[y0][y] * self.emit_p[y][obs[t]], y0))
+                    ar.append((V[t - 1][y0] * self.model.transition(y0, y) * e, y0))
                 (prob, state) = max(ar)
                 V[t][y] = prob
                 newpath[y] = path[state] + [y]
@@ -363,7 +751,199 @@ class ViterbiTrainer:
         (prob, state) = max((V[n][y], y) for y in self.states)
         return path[state]
 
-m = HMM('C:\\Users\\asus\\PycharmProjects\\yiddish\\yiddish_parsed_cases', printing=True, ambig=True)
+    def collect_word_states(self):
+        """
+        Returns a dictionary {word: [tags the word was seen with in the training corpus]}.
+        """
+        d = defaultdict(list)
+        for y in self.states:
+            for w in self.model.emissionProbabilities.get(y, {}):
+                d[w].append(y)
+        return d
+
+    def candidate_states(self, word, anas):
+        """
+        Returns the tags that the trellis holds for a word.
+        These are the tags proposed by the morphological parser that are known to the model.
+        If there are none, falls back to the tags the word was seen with in the training corpus,
+        and if the word is unknown too - to all the tags of the model.
+        """
+        cands = []
+        for gr, ana in anas:
+            if gr in self.states2 and gr not in cands:
+                cands.append(gr)
+        if cands == []:
+            cands = self.wordStates.get(word, [])
+        if cands == []:
+            cands = self.states
+        return cands
+
+    def viterbi_lattice(self, obs, sentWords):
+        """
+        Same as viterbi(), but at each position only the candidate tags of the word are scored,
+        so a sentence costs O(T*K*K) with K candidates per word instead of O(T*S*S).
+        """
+        lattice = [self.candidate_states(obs[t], sentWords[t]) for t in range(len(obs))]
+
+        V = {}
+        for y in lattice[0]:
+            V[y] = self.model.start(y) * self.model.emission(y, obs[0])
+        back = []
 
-p = 'C:\\Users\\asus\\PycharmProjects\\yiddish\\yiddish_parsed_cases_run_viterbi'
-v = ViterbiTrainer(m, p)
\ No newline at end of file
+        for t in range(1, len(obs)):
+            newV = {}
+            pointers = {}
+            for y in lattice[t]:
+                e = self.model.emission(y, obs[t])
+                ar = []
+                for y0 in V:
+                    ar.append((V[y0] * self.model.transition(y0, y) * e, y0))
+                (prob, state) = max(ar)
+                newV[y] = prob
+                pointers[y] = state
+            back.append(pointers)
+            V = newV
+
+        (prob, state) = max((V[y], y) for y in V)
+        tags = [state]
+        for pointers in reversed(back):
+            state = pointers[state]
+            tags.append(state)
+        tags.reverse()
+        return tags
+
+    def compile_model(self):
+        """
+        Turns the probability dictionaries into arrays indexed by integer tag ids:
+        start probabilities, a dense S x S transition matrix,
+        emissions of unseen words and, for every seen word, the ids and emissions of its tags.
+        Smoothing is the same as in viterbi().
+        """
+        print "Compiling the model..."
+        # max() over (prob, tag) tuples prefers the greater tag in case of a tie,
+        # argmax prefers the first index, so the tags are numbered in reverse order
+        self.tagList = sorted(self.states, reverse=True)
+        self.tagIds = dict((y, i) for i, y in enumerate(self.tagList))
+        nStates = len(self.tagList)
+        counts = np.array([self.states2[y] for y in self.tagList], dtype=np.float64)
+
+        self.startProbs = np.array([self.model.start(y) for y in self.tagList], dtype=np.float64)
+
+        trans = np.tile(1 / (counts + nStates), (nStates, 1))  # trans[y0, y]
+        for i in xrange(nStates):
+            for y, p in self.model.transitionProbabilities.get(self.tagList[i], {}).iteritems():
+                if y in self.tagIds:
+                    trans[i, self.tagIds[y]] = p
+        self.transProbs = trans
+
+        self.unseenProbs = 1 / (counts + self.model.numObservations)
+        words = defaultdict(list)
+        for i in xrange(nStates):
+            for w, p in self.model.emissionProbabilities.get(self.tagList[i], {}).iteritems():
+                words[w].append((i, p))
+        self.wordEmissions = {}
+        for w in words:
+            ids, probs = zip(*words[w])
+            self.wordEmissions[w] = (np.array(ids, dtype=np.int32), np.array(probs, dtype=np.float64))
+
+    def emission_column(self, word):
+        """
+        Returns the vector of emission probabilities of the word for all tags.
+        """
+        col = self.unseenProbs.copy()
+        if word in self.wordEmissions:
+            ids, probs = self.wordEmissions[word]
+            col[ids] = probs
+        return col
+
+    def viterbi_vectorized(self, obs):
+        """
+        Viterbi over integer tag ids.
+        Each time step is one argmax over the S x S matrix of scores,
+        the best path is restored from an int backpointer array instead of copying the paths.
+        The scores are products multiplied in the same order as in viterbi(), so equal paths stay equal
+        and the ties are broken in the same way (sums of logs may differ in the last bit).
+        Before each step the scores are divided by a power of two, which is exact,
+        so long sentences don't underflow. Doesn't write smoothed values to the model.
+        """
+        nStates = len(self.tagList)
+        columns = np.arange(nStates)
+        back = np.zeros((len(obs), nStates), dtype=np.int32)
+        delta = self.startProbs * self.emission_column(obs[0])
+        for t in xrange(1, len(obs)):
+            delta = np.ldexp(delta, -np.frexp(delta.max())[1])
+            scores = delta[:, np.newaxis] * self.transProbs  # scores[y0, y]
+            scores *= self.emission_column(obs[t])
+            back[t] = scores.argmax(axis=0)
+            delta = scores[back[t], columns]
+        state = int(delta.argmax())
+        path = [state]
+        for t in xrange(len(obs) - 1, 0, -1):
+            state = back[t, state]
+            path.append(state)
+        return [self.tagList[i] for i in reversed(path)]
+
+    def viterbi_batch(self, sents):
+        """
+        Decodes many sentences at once and returns their tags in the same order.
+        Sentences of the same length are stacked, so the recursion runs over (batch, time, state) arrays
+        with one argmax per time step for the whole group (see viterbi_stack).
+        """
+        nStates = len(self.tagList)
+        maxBatch = max(1, self.batchCells // (nStates * nStates))
+        byLength = defaultdict(list)
+        for i in xrange(len(sents)):
+            byLength[len(sents[i])].append(i)
+        result = [None] * len(sents)
+        for length in byLength:
+            group = byLength[length]
+            for b in xrange(0, len(group), maxBatch):
+                ids = group[b:b + maxBatch]
+                emissions = np.array([[self.emission_column(w) for w in sents[i]] for i in ids])
+                paths = self.viterbi_stack(emissions)
+                for i, path in zip(ids, paths):
+                    result[i] = [self.tagList[y] for y in path]
+        return result
+
+    def viterbi_stack(self, emissions):
+        """
+        Viterbi for a (batch, time, state) array of emissions of sentences of equal length,
+        the scores are computed and rescaled as in viterbi_vectorized, every sentence with its own power of two.
+        Returns a (batch, time) array of tag ids.
+        """
+        nBatch, length, nStates = emissions.shape
+        back = np.zeros((nBatch, length, nStates), dtype=np.int32)
+        delta = self.startProbs * emissions[:, 0]
+        for t in xrange(1, length):
+            delta = np.ldexp(delta, -np.frexp(delta.max(axis=1))[1][:, np.newaxis])
+            scores = delta[:, :, np.newaxis] * self.transProbs * emissions[:, t, np.newaxis]  # scores[b, y0, y]
+            back[:, t] = scores.argmax(axis=1)
+            delta = scores.max(axis=1)
+        paths = np.zeros((nBatch, length), dtype=np.int32)
+        paths[:, -1] = delta.argmax(axis=1)
+        rows = np.arange(nBatch)
+        for t in xrange(length - 1, 0, -1):
+            paths[:, t - 1] = back[rows, t, paths[:, t]]
+        return paths
+
+
+def viterbi_init_worker(trainer):
+    """
+    Runs once in every worker process of ViterbiTrainer and keeps the trainer for the tasks.
+    """
+    global workerTrainer
+    workerTrainer = trainer
+
+
+def viterbi_decode_files(fNames):
+    """
+    Runs in a worker process of ViterbiTrainer, decodes and rewrites a group of files.
+    """
+    return workerTrainer.decode_files(fNames)
+
+
+if __name__ == '__main__':
+    m = HMM('C:\\Users\\asus\\PycharmProjects\\yiddish\\yiddish_parsed_cases', printing=True, ambig=True)
+
+    p = 'C:\\Users\\asus\\PycharmProjects\\yiddish\\yiddish_parsed_cases_run_viterbi'
+    v = ViterbiTrainer(m, p)